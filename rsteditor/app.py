@@ -8,6 +8,8 @@ import logging
 import logging.handlers
 import argparse
 import threading
+import time
+import multiprocessing
 from functools import partial
 
 from PyQt5 import QtGui, QtCore, QtWidgets, QtPrintSupport
@@ -24,9 +26,16 @@ from rsteditor import editor
 from rsteditor import webview
 from rsteditor import explorer
 from rsteditor import output
+from rsteditor import dependency
+from rsteditor import exporter
+from rsteditor import scheduler
+from rsteditor import executor
+from rsteditor import cache
+from rsteditor import timing
 from rsteditor.util import toUtf8, toBytes
 from rsteditor import globalvars
 from .findreplace import FindReplaceDialog
+from .diagnostics import DiagnosticsDialog
 
 
 ALLOWED_LOADS = ['.rst', '.rest',
@@ -38,47 +47,70 @@ ALLOWED_LOADS = ['.rst', '.rest',
                  '.py'
                  ]
 
-requestPreview = threading.Event()
-
 # for debug
 LOG_FILENAME = os.path.join(__home_data_path__, 'rsteditor.log')
 
+# render timing of preview
+TIMING_FILENAME = os.path.join(__home_data_path__, 'render_timing.jsonl')
+
 # for logger
 logger = None
 
 
 def previewWorker(self):
     while True:
-        requestPreview.wait()
-        if self.previewQuit:
+        job = self.previewScheduler.take()
+        if job is None:
             logger.debug('Preview exit')
             break
-        logger.debug('Preview %s', self.previewPath)
-        ext = os.path.splitext(self.previewPath)[1].lower()
-        self.previewHtml = ''
+        logger.debug('Preview %s(%s)', job.path, job.generation)
+        t1 = time.monotonic()
+        job.timings = {}
+        ext = os.path.splitext(job.path)[1].lower()
         if ext in ['.rst', '.rest', '.txt']:
-            self.previewHtml = output.rst2htmlcode(self.previewText,
-                                                   theme=self.theme,
-                                                   pygments=self.pygments)
+            theme = job.options['theme']
+            pygments = job.options['pygments']
+            settings = output.get_math_overrides(job.options['math'])
+            if job.options['draft']:
+                settings.update(output.draft_overrides)
+            focus = job.options['focus']
+            key = output.htmlcode_key(job.text, theme, pygments, settings,
+                                      focus, job.path)
+            cached = self.previewCache.get(key)
+            # included files may be changed on disk
+            if cached and not dependency.changed(cached[1]):
+                job.html, job.dependencies = cached
+            else:
+                job.html = self.previewExecutor.render(
+                    job.text, theme=theme, pygments=pygments,
+                    settings=settings, timings=job.timings, focus=focus,
+                    dependencies=job.dependencies, source_path=job.path)
+                # error message is str
+                if isinstance(job.html, bytes):
+                    self.previewCache.put(key, (job.html, job.dependencies),
+                                          len(job.html))
         elif ext in ['.html', '.htm']:
-            self.previewHtml = self.previewText
+            job.html = job.text
         elif ext in ALLOWED_LOADS:
-            self.previewHtml = '<html><strong>Do not support preview.</strong></html>'
+            job.html = '<html><strong>Do not support preview.</strong></html>'
         else:
-            self.previewPath = 'error'
-        self.previewSignal.emit()
-        requestPreview.clear()
+            job.path = 'error'
+        job.timings['render'] = time.monotonic() - t1
+        if self.previewScheduler.done(job, job.timings['render']):
+            self.previewSignal.emit(job)
     return
 
 
 class MainWindow(QtWidgets.QMainWindow):
     theme = 'docutils'
     pygments = 'docutils'
-    previewText = ''
+    mathOutput = 'html'
     previewHtml = ''
     previewPath = None
-    previewQuit = False
-    previewSignal = QtCore.pyqtSignal()
+    previewScrolling = False
+    # (job, start time) shown by webview, timings are recorded when it is done
+    displayJob = None
+    previewSignal = QtCore.pyqtSignal(object)
 
     def __init__(self):
         super(MainWindow, self).__init__()
@@ -225,6 +257,37 @@ class MainWindow(QtWidgets.QMainWindow):
         value = settings.value('preview/sync', True, type=bool)
         settings.setValue('preview/sync', value)
         previewsyncAction.setChecked(value)
+        self.previewSync = value
+        previewprocessAction = QtWidgets.QAction(
+            self.tr('Render in separate process'),
+            self,
+            checkable=True)
+        previewprocessAction.triggered.connect(partial(self.onPreview,
+                                                       'previewprocess'))
+        value = toUtf8(settings.value('preview/backend', 'process', type=str))
+        settings.setValue('preview/backend', value)
+        previewprocessAction.setChecked(value == 'process')
+        previewtimingAction = QtWidgets.QAction(
+            self.tr('Log render timing'),
+            self,
+            checkable=True)
+        previewtimingAction.triggered.connect(partial(self.onPreview,
+                                                      'previewtiming'))
+        value = settings.value('preview/timingLog', False, type=bool)
+        settings.setValue('preview/timingLog', value)
+        previewtimingAction.setChecked(value)
+        mathGroup = QtWidgets.QActionGroup(self)
+        mathGroup.setExclusive(True)
+        value = toUtf8(settings.value('preview/mathOutput', 'html', type=str))
+        if value not in output.math_outputs:
+            value = 'html'
+        settings.setValue('preview/mathOutput', value)
+        self.mathOutput = value
+        for k, v in output.math_outputs.items():
+            act = QtWidgets.QAction(v, self, checkable=True)
+            act.triggered.connect(partial(self.onMathOutputChanged, k))
+            act.setChecked(k == value)
+            mathGroup.addAction(act)
         # theme
         # docutils theme
         docutils_cssAction = QtWidgets.QAction('docutils theme',
@@ -271,6 +334,9 @@ class MainWindow(QtWidgets.QMainWindow):
         # help
         helpAction = QtWidgets.QAction(self.tr('&Help'), self)
         helpAction.triggered.connect(self.onHelp)
+        diagnosticsAction = QtWidgets.QAction(self.tr('Render &diagnostics'),
+                                              self)
+        diagnosticsAction.triggered.connect(self.onDiagnostics)
         aboutAction = QtWidgets.QAction(self.tr('&About'), self)
         aboutAction.triggered.connect(self.onAbout)
         aboutqtAction = QtWidgets.QAction(self.tr('About &Qt'), self)
@@ -286,7 +352,7 @@ class MainWindow(QtWidgets.QMainWindow):
         menu.addAction(saveAsAction)
         menu.addSeparator()
         menu.addAction(exportHTMLAction)
-        # menu.addAction(exportODTAction)
+        menu.addAction(exportODTAction)
         menu.addSeparator()
         menu.addAction(printPreviewAction)
         menu.addAction(printAction)
@@ -324,6 +390,13 @@ class MainWindow(QtWidgets.QMainWindow):
         menu.addAction(previewsaveAction)
         menu.addAction(previewinputAction)
         menu.addAction(previewsyncAction)
+        menu.addAction(previewprocessAction)
+        menu.addAction(previewtimingAction)
+        menu.addSeparator()
+        submenu = QtWidgets.QMenu(self.tr('&Math output'), menu)
+        for act in mathGroup.actions():
+            submenu.addAction(act)
+        menu.addMenu(submenu)
         menu = menubar.addMenu(self.tr('&Theme'))
         submenu = QtWidgets.QMenu(self.tr('&Docutils'), menu)
         for act in themeGroup.actions():
@@ -336,6 +409,7 @@ class MainWindow(QtWidgets.QMainWindow):
         menu.addMenu(submenu)
         menu = menubar.addMenu(self.tr('&Help'))
         menu.addAction(helpAction)
+        menu.addAction(diagnosticsAction)
         menu.addSeparator()
         menu.addAction(aboutAction)
         menu.addAction(aboutqtAction)
@@ -378,7 +452,15 @@ class MainWindow(QtWidgets.QMainWindow):
         self.explorer.fileDeleted.connect(self.onFileDeleted)
         self.editor.verticalScrollBar().valueChanged.connect(
             self.onValueChanged)
+        self.scrollStats = {'sent': 0, 'dropped': 0}
+        self.scrollTimer = QtCore.QTimer(self)
+        self.scrollTimer.setSingleShot(True)
+        rate = QtWidgets.QApplication.primaryScreen().refreshRate() or 60
+        self.scrollTimer.setInterval(max(1, int(1000 / rate)))
+        self.scrollTimer.timeout.connect(self.onScrollTimer)
         self.editor.lineInputed.connect(self.onInputPreview)
+        self.webview.sourceLineScrolled.connect(self.onPreviewScrolled)
+        self.webview.htmlDisplayed.connect(self.onPreviewDisplayed)
         # window state
         self.restoreGeometry(settings.value('geometry', type=QtCore.QByteArray))
         self.restoreState(settings.value('windowState', type=QtCore.QByteArray))
@@ -390,6 +472,51 @@ class MainWindow(QtWidgets.QMainWindow):
         self.editor.emptyFile()
         value = enableLexerAction.isChecked()
         self.editor.enableLexer(value)
+        self.previewScheduler = scheduler.PreviewScheduler()
+        value = settings.value('preview/cacheSize', 32, type=int)
+        settings.setValue('preview/cacheSize', value)
+        self.previewCache = cache.LRUCache(value * 1024 * 1024)
+        value = settings.value('preview/draftBudget', 500, type=int)
+        settings.setValue('preview/draftBudget', value)
+        self.previewScheduler.draft_budget = value / 1000.0
+        # full render after draft when editor is idle
+        self.finalTimer = QtCore.QTimer(self)
+        self.finalTimer.setSingleShot(True)
+        value = settings.value('preview/idleDelay', 1000, type=int)
+        settings.setValue('preview/idleDelay', value)
+        self.finalTimer.setInterval(value)
+        self.finalTimer.timeout.connect(self.previewCurrentText)
+        # larger documents are previewed around cursor, 0 disables
+        value = settings.value('preview/partialLines', 5000, type=int)
+        settings.setValue('preview/partialLines', value)
+        self.previewPartialLines = value
+        # preview again when an included file is changed on disk
+        self.dependencyWatcher = QtCore.QFileSystemWatcher(self)
+        self.dependencyWatcher.fileChanged.connect(self.onDependencyChanged)
+        self.dependencyTimer = QtCore.QTimer(self)
+        self.dependencyTimer.setSingleShot(True)
+        self.dependencyTimer.setInterval(300)
+        self.dependencyTimer.timeout.connect(self.previewCurrentText)
+        self.renderStats = timing.RenderStats()
+        if settings.value('preview/timingLog', type=bool):
+            self.renderStats.log_path = TIMING_FILENAME
+        self.timingLabel = QtWidgets.QLabel(self)
+        self.statusBar().addPermanentWidget(self.timingLabel)
+        # export runs in worker process
+        self.exportJob = None
+        self.exportProgress = QtWidgets.QProgressBar(self)
+        self.exportProgress.setMaximumWidth(160)
+        self.exportProgress.setRange(0, 100)
+        self.exportProgress.hide()
+        self.statusBar().addPermanentWidget(self.exportProgress)
+        self.exportCancel = QtWidgets.QToolButton(self)
+        self.exportCancel.setText(self.tr('Cancel'))
+        self.exportCancel.setToolTip(self.tr('Cancel export'))
+        self.exportCancel.clicked.connect(self.onExportCancel)
+        self.exportCancel.hide()
+        self.statusBar().addPermanentWidget(self.exportCancel)
+        self.previewExecutor = executor.create(
+            toUtf8(settings.value('preview/backend', type=str)))
         self.previewWorker = threading.Thread(target=previewWorker,
                                               args=(self,))
         self.previewSignal.connect(self.previewDisplay)
@@ -406,9 +533,11 @@ class MainWindow(QtWidgets.QMainWindow):
         settings.setValue('windowState', self.saveState())
         settings.setValue('explorer/rootPath', self.explorer.getRootPath())
         settings.sync()
-        self.previewQuit = True
-        requestPreview.set()
+        self.previewScheduler.quit()
         self.previewWorker.join()
+        self.previewExecutor.shutdown()
+        if self.exportJob:
+            self.exportJob.cancel()
         logger.info('=== rsteditor end ===')
 
     def onNew(self, path=None):
@@ -508,9 +637,10 @@ class MainWindow(QtWidgets.QMainWindow):
                 ext = os.path.splitext(filename)[1].lower()
                 if ext not in ['.html', '.htm']:
                     filename += '.html'
-                output.rst2html(self.editor.getFileName(),
-                                filename,
-                                theme=self.theme)
+                self.startExport('html', filename,
+                                 theme=self.theme,
+                                 settings=output.get_math_overrides(
+                                     self.mathOutput))
         elif label == 'odt':
             filename = QtWidgets.QFileDialog.getSaveFileName(
                 self,
@@ -518,12 +648,56 @@ class MainWindow(QtWidgets.QMainWindow):
                 self.explorer.getRootPath(),
                 "ODT files (*.odt)",
             )
+            if isinstance(filename, tuple):
+                filename = filename[0]
             if filename:
                 filename = toUtf8(filename)
                 ext = os.path.splitext(filename)[1].lower()
                 if ext not in ['.odt']:
                     filename += '.odt'
-                output.rst2odt(self.editor.getFileName(), filename)
+                self.startExport('odt', filename)
+
+    def startExport(self, kind, filename, **options):
+        if self.exportJob:
+            self.statusBar().showMessage(
+                self.tr('Export is running: %s') % self.exportJob.filename)
+            return
+        self.exportJob = exporter.ExportJob(
+            kind, self.editor.getFileName(), filename, self, **options)
+        self.exportJob.progress.connect(self.onExportProgress)
+        self.exportJob.finished.connect(self.onExportFinished)
+        self.exportProgress.setValue(0)
+        self.exportProgress.show()
+        self.exportCancel.show()
+        self.statusBar().showMessage(self.tr('Exporting %s') % filename)
+        try:
+            self.exportJob.start()
+        except OSError as err:
+            self.exportJob = None
+            self.onExportFinished(False, str(err))
+
+    def onExportProgress(self, percent, stage):
+        self.exportProgress.setValue(percent)
+        self.statusBar().showMessage(self.tr('Exporting %s: %s') % (
+            self.exportJob.filename, stage))
+
+    def onExportCancel(self):
+        if self.exportJob:
+            self.exportJob.cancel()
+            self.statusBar().showMessage(self.tr('Export cancelled'), 5000)
+
+    def onExportFinished(self, success, message):
+        if self.exportJob:
+            self.exportJob.deleteLater()
+            self.exportJob = None
+        self.exportProgress.hide()
+        self.exportCancel.hide()
+        if success:
+            self.statusBar().showMessage(
+                self.tr('Exported to %s') % message, 5000)
+        else:
+            self.statusBar().showMessage(
+                self.tr('Export failed: %s') % message, 5000)
 
     def onPrintPreview(self):
         if self.editor.hasFocus():
@@ -690,6 +864,16 @@ class MainWindow(QtWidgets.QMainWindow):
             self.settings.setValue('preview/oninput', checked)
         elif label == 'previewsync':
             self.settings.setValue('preview/sync', checked)
+            self.previewSync = checked
+        elif label == 'previewtiming':
+            self.settings.setValue('preview/timingLog', checked)
+            self.renderStats.log_path = TIMING_FILENAME if checked else None
+        elif label == 'previewprocess':
+            backend = 'process' if checked else 'thread'
+            self.settings.setValue('preview/backend', backend)
+            old_executor = self.previewExecutor
+            self.previewExecutor = executor.create(backend)
+            old_executor.shutdown()
         elif label == 'enablelexer':
             self.settings.setValue('editor/enableLexer', checked)
             self.editor.enableLexer(checked)
@@ -707,6 +891,11 @@ class MainWindow(QtWidgets.QMainWindow):
                 act.trigger()
                 break
 
+    def onMathOutputChanged(self, label, checked):
+        self.mathOutput = label
+        self.settings.setValue('preview/mathOutput', self.mathOutput)
+        self.previewCurrentText()
+
     def onCodeStyleChanged(self, label, checked):
         self.pygments = label
         self.settings.setValue('pygments', self.pygments)
@@ -716,6 +905,8 @@ class MainWindow(QtWidgets.QMainWindow):
             if self.pygments != 'null':
                 formatter = get_formatter_by_name('html', style=self.pygments)
                 f.write(toBytes(formatter.get_style_defs('pre.code')))
+        # don't wait for the registry to find the new pygments.css
+        self.previewExecutor.reloadThemes()
         self.previewCurrentText()
 
     def onHelp(self):
@@ -739,8 +930,47 @@ class MainWindow(QtWidgets.QMainWindow):
         text += self.tr('Platform: %s\n') % (sys.platform)
         text += self.tr('Configuration path: %s\n') % (__home_data_path__)
         text += self.tr('Scilexer: %s\n') % self.editor.cur_lexer.__module__
+        text += self.tr('Preview backend: %s\n') % self.previewExecutor.name
+        stats = self.previewCache.stats()
+        text += self.tr('Preview cache: %s items, %.1f/%.1f MB\n') % (
+            stats['items'],
+            stats['bytes'] / 1024.0 / 1024.0,
+            stats['max_bytes'] / 1024.0 / 1024.0)
+        text += self.tr('Preview cache hits: %s, misses: %s, evictions: %s\n') % (
+            stats['hits'], stats['misses'], stats['evictions'])
+        text += self.tr('Scroll synchronize: %s sent, %s dropped\n') % (
+            self.scrollStats['sent'], self.scrollStats['dropped'])
         QtWidgets.QMessageBox.about(self, title, text)
 
+    def showRenderTiming(self, timings, draft=False):
+        # code viewer is updated while the page is displayed
+        total = sum(timings.get(s, 0) for s in ('render', 'display'))
+        summary = self.renderStats.summary()
+        if draft:
+            text = self.tr('Draft preview: %.0f ms') % (total * 1000)
+        else:
+            text = self.tr('Preview: %.0f ms') % (total * 1000)
+        if 'render' in summary:
+            text += self.tr(', render p95: %.0f ms') % (summary['render'][2] * 1000)
+        self.timingLabel.setText(text)
+
+    def onDiagnostics(self):
+        dialog = DiagnosticsDialog(self.diagnosticsReport, self)
+        dialog.reset.connect(self.renderStats.clear)
+        dialog.exec_()
+
+    def diagnosticsReport(self):
+        text = self.tr('Preview stages in milliseconds:\n\n')
+        text += self.renderStats.report()
+        text += '\n\n'
+        text += self.tr('Scheduler: %s\n') % self.previewScheduler.stats
+        for name, stats in self.previewExecutor.cacheStats():
+            text += '%s: %s\n' % (name, stats)
+        text += self.tr('Cache: %s\n') % self.previewCache.stats()
+        if self.renderStats.log_path:
+            text += self.tr('Log: %s\n') % self.renderStats.log_path
+        return text
+
     def onFileLoaded(self, path):
         if not self.saveAndContinue():
             return
@@ -758,17 +988,36 @@ class MainWindow(QtWidgets.QMainWindow):
         return
 
     def onValueChanged(self, value):
-        if self.settings.value('preview/sync', type=bool):
-            dy = self.editor.getVScrollValue()
-            editor_vmax = self.editor.getVScrollMaximum()
-            if editor_vmax:
-                self.webview.scrollRatioPage(dy, editor_vmax)
+        if self.previewScrolling or not self.previewSync:
+            return
+        # send the latest position once per frame
+        if self.scrollTimer.isActive():
+            self.scrollStats['dropped'] += 1
+        else:
+            self.scrollTimer.start()
         return
 
+    def onScrollTimer(self):
+        self.scrollStats['sent'] += 1
+        self.syncPreviewScroll()
+
+    def syncPreviewScroll(self):
+        dy = self.editor.getVScrollValue()
+        editor_vmax = self.editor.getVScrollMaximum()
+        line = self.editor.getFirstVisibleDocLine()
+        self.webview.scrollSourceLine(line, dy, editor_vmax)
+
+    def onPreviewScrolled(self, line):
+        if self.previewSync:
+            # don't scroll preview back
+            self.previewScrolling = True
+            self.editor.setFirstVisibleDocLine(line)
+            self.previewScrolling = False
+
     def onInputPreview(self):
         if self.settings.value('preview/oninput', type=bool):
             text = toUtf8(self.editor.getValue())
-            self.preview(text, self.editor.getFileName())
+            self.preview(text, self.editor.getFileName(), False)
         return
 
     def onFileRenamed(self, old_name, new_name):
@@ -793,29 +1042,85 @@ class MainWindow(QtWidgets.QMainWindow):
         qr.moveCenter(cp)
         self.move(qr.topLeft())
 
-    def preview(self, text, path):
-        if not requestPreview.is_set():
-            self.previewText = text
-            self.previewPath = path
-            requestPreview.set()
+    def preview(self, text, path, urgent=True):
+        # unsaved document is in explorer directory
+        if path and not os.path.isabs(path):
+            path = os.path.abspath(
+                os.path.join(self.explorer.getRootPath() or '', path))
+        # typing gets draft preview, full one follows when idle
+        draft = not urgent and self.previewScheduler.useDraft()
+        if draft:
+            self.finalTimer.start()
         else:
-            logger.debug('Preview is working...')
+            self.finalTimer.stop()
+        focus = None
+        if self.previewPartialLines and \
+                text.count('\n') >= self.previewPartialLines:
+            focus = self.editor.getCursorPosition()[0] + 1
+        self.previewScheduler.request(text, path, urgent,
+                                      theme=self.theme,
+                                      pygments=self.pygments,
+                                      math=self.mathOutput,
+                                      draft=draft,
+                                      focus=focus)
         return
 
     def previewCurrentText(self):
         text = toUtf8(self.editor.getValue())
         self.preview(text, self.editor.getFileName())
 
-    def previewDisplay(self):
-        self.webview.setHtml(self.previewHtml, self.previewPath)
-        self.codeview.setValue(self.previewHtml)
-        self.codeview.setFileName(self.previewPath + '.html')
-        dy = self.editor.getVScrollValue()
-        editor_vmax = self.editor.getVScrollMaximum()
-        if editor_vmax:
-            self.webview.scrollRatioPage(dy, editor_vmax)
+    def previewDisplay(self, job):
+        if not self.previewScheduler.isCurrent(job.generation):
+            self.previewScheduler.discard(job)
+            return
+        self.previewHtml = job.html
+        self.previewPath = job.path
+        if self.displayJob:
+            # replaced before it was shown, no display timing
+            self.recordRender(self.displayJob[0])
+        # display ends when page is patched or loaded, see onPreviewDisplayed
+        self.displayJob = (job, time.monotonic())
+        self.webview.updateHtml(self.previewHtml, self.previewPath)
+        with timing.measure(job.timings, 'codeview'):
+            self.codeview.updateValue(
+                output.strip_source_lines(self.previewHtml),
+                self.previewPath + '.html')
+        self.syncPreviewScroll()
+        self.watchDependencies(job.dependencies)
         self.editor.setFocus()
 
+    def onPreviewDisplayed(self, loaded):
+        if loaded:
+            # scrolled before the page was loaded, see previewDisplay
+            self.syncPreviewScroll()
+        if not self.displayJob:
+            return
+        job, start = self.displayJob
+        self.displayJob = None
+        job.timings['display'] = time.monotonic() - start
+        self.recordRender(job)
+
+    def recordRender(self, job):
+        self.renderStats.record(job.timings, path=job.path,
+                                generation=job.generation,
+                                draft=job.options.get('draft', False))
+        self.showRenderTiming(job.timings, job.options.get('draft'))
+
+    def watchDependencies(self, dependencies):
+        paths = set(path for path, _ in dependencies)
+        watched = set(self.dependencyWatcher.files())
+        removed = watched - paths
+        if removed:
+            self.dependencyWatcher.removePaths(list(removed))
+        added = [path for path in paths - watched if os.path.exists(path)]
+        if added:
+            self.dependencyWatcher.addPaths(added)
+
+    def onDependencyChanged(self, path):
+        logger.debug('Dependency changed: %s', path)
+        # editors save by several writes or rename
+        self.dependencyTimer.start()
+
     def saveAndContinue(self):
         if self.editor.isModified():
             msgBox = QtWidgets.QMessageBox(self)
@@ -876,6 +1181,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
 
 def main():
+    multiprocessing.freeze_support()
     globalvars.init()
     parser = argparse.ArgumentParser()
     parser.add_argument('--style', choices=QtWidgets.QStyleFactory.keys())
@@ -932,6 +1238,7 @@ def main():
     QtWidgets.QApplication.setStyle(args.style)
     if sys.platform == 'win32':
         QtWidgets.QApplication.setAttribute(QtCore.Qt.AA_EnableHighDpiScaling)
+    webview.registerScheme()
     app = QtWidgets.QApplication(sys.argv)
     logger.debug('qt plugin path: ' + ', '.join(app.libraryPaths()))
     win = MainWindow()
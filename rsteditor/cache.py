@@ -0,0 +1,76 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def hash_key(*values):
+    """ content hash of values, str values are encoded as utf-8 """
+    digest = hashlib.sha1()
+    for value in values:
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        elif not isinstance(value, bytes):
+            value = repr(value).encode('utf-8')
+        digest.update(value)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class LRUCache(object):
+    """
+    Least recently used cache limited by total size of values in bytes.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, old_size) = self._items.popitem(last=False)
+                self._bytes -= old_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'items': len(self._items),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,151 @@
+import os
+import logging
+
+from docutils import io, nodes
+from docutils.utils import SystemMessagePropagation
+from docutils.parsers.rst import directives
+from docutils.parsers.rst.directives import misc, tables
+
+from rsteditor.cache import LRUCache, hash_key
+
+logger = logging.getLogger(__name__)
+
+
+def stat_key(path):
+    """ (mtime, size) of file, None if it can't be read """
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def snapshot(paths):
+    """ result: [(absolute path, stat_key), ...] """
+    result = []
+    for path in paths:
+        path = os.path.abspath(path)
+        result.append((path, stat_key(path)))
+    return result
+
+
+def changed(dependencies):
+    """ any file of snapshot has been modified, created or removed """
+    for path, key in dependencies:
+        if stat_key(path) != key:
+            return True
+    return False
+
+
+class FileCache(object):
+    """
+    Decoded text of files read by directives.  Files are keyed by path,
+    encoding, mtime and size, so a modified file is read again.
+    """
+    def __init__(self, max_bytes):
+        self._cache = LRUCache(max_bytes)
+
+    def read(self, path, encoding=None, error_handler='strict'):
+        """ raise OSError and UnicodeError as docutils.io.FileInput """
+        stat = stat_key(path)
+        key = hash_key(os.path.abspath(path), encoding, error_handler, stat)
+        text = self._cache.get(key) if stat else None
+        if text is None:
+            text = io.FileInput(source_path=path, encoding=encoding,
+                                error_handler=error_handler).read()
+            if stat:
+                self._cache.put(key, text)
+        return text
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+# files of include and csv-table directives, shared by all renders
+fileCache = FileCache(32 * 1024 * 1024)
+
+
+class Include(misc.Include):
+    """
+    include directive reading files through fileCache.  read_file and
+    clip_options are hooks of docutils 0.22, see requirement.txt
+    """
+    def read_file(self, path):
+        encoding = self.options.get('encoding', self.settings.input_encoding)
+        error_handler = self.settings.input_encoding_error_handler
+        try:
+            text = fileCache.read(path, encoding, error_handler)
+        except UnicodeEncodeError:
+            raise self.error(f'Problems with "{self.name}" directive path:\n'
+                             f'Cannot encode input file path "{path}" '
+                             '(wrong locale?).')
+        except OSError as error:
+            # a missing file may be created later
+            self.settings.record_dependencies.add(path)
+            raise self.error(f'Problems with "{self.name}" directive path:\n'
+                             f'{io.error_string(error)}.')
+        except UnicodeError as error:
+            self.settings.record_dependencies.add(path)
+            raise self.error(f'Problem with "{self.name}" directive:\n'
+                             + io.error_string(error))
+        self.settings.record_dependencies.add(path)
+        # clip as docutils
+        startline, endline, starttext, endtext = self.clip_options
+        if startline or (endline is not None):
+            lines = text.splitlines()
+            text = '\n'.join(lines[startline:endline])
+        if starttext == "":
+            starttext = '\n\n'
+        if starttext:
+            after_index = text.find(starttext)
+            if after_index < 0:
+                raise self.error('Problem with "start-after" option of '
+                                 f'"{self.name}" directive:\nText not found.')
+            text = text[after_index + len(starttext):]
+        if endtext == "":
+            before_index = text.find('\n\n')
+            if before_index > 0:
+                text = text[:before_index+1]
+        elif endtext:
+            before_index = text.find(endtext)
+            if before_index < 0:
+                raise self.error('Problem with "end-before" option of '
+                                 f'"{self.name}" directive:\nText not found.')
+            text = text[:before_index]
+        return text
+
+
+class CSVTable(tables.CSVTable):
+    """ csv-table directive reading :file: through fileCache """
+    def get_csv_data(self):
+        if self.content or 'file' not in self.options or \
+                'url' in self.options:
+            return super(CSVTable, self).get_csv_data()
+        settings = self.state.document.settings
+        encoding = self.options.get('encoding', settings.input_encoding)
+        error_handler = settings.input_encoding_error_handler
+        source = misc.adapt_path(self.options['file'],
+                                 self.state.document.current_source,
+                                 settings.root_prefix)
+        try:
+            csv_data = fileCache.read(
+                source, encoding, error_handler).splitlines()
+        except OSError as error:
+            settings.record_dependencies.add(source)
+            severe = self.reporter.severe(
+                'Problems with "%s" directive path:\n%s.'
+                % (self.name, error),
+                nodes.literal_block(self.block_text, self.block_text),
+                line=self.lineno)
+            raise SystemMessagePropagation(severe)
+        settings.record_dependencies.add(source)
+        return csv_data, source
+
+
+def register():
+    """ replace directives of docutils, see output.py """
+    directives.register_directive('include', Include)
+    directives.register_directive('csv-table', CSVTable)
@@ -0,0 +1,35 @@
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+
+class DiagnosticsDialog(QtWidgets.QDialog):
+    """ show text of report function and refresh it every second """
+    reset = QtCore.pyqtSignal()
+
+    def __init__(self, report, *args, **kwargs):
+        super(DiagnosticsDialog, self).__init__(*args, **kwargs)
+        self.report = report
+        self.setWindowTitle(self.tr('Render diagnostics'))
+        self.resize(560, 360)
+        self.textEdit = QtWidgets.QPlainTextEdit(self)
+        self.textEdit.setReadOnly(True)
+        self.textEdit.setFont(
+            QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        buttons = QtWidgets.QDialogButtonBox(self)
+        buttons.addButton(QtWidgets.QDialogButtonBox.Close)
+        resetButton = buttons.addButton(QtWidgets.QDialogButtonBox.Reset)
+        buttons.rejected.connect(self.close)
+        resetButton.clicked.connect(self.onReset)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.textEdit)
+        layout.addWidget(buttons)
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(1000)
+        self.refresh()
+
+    def onReset(self):
+        self.reset.emit()
+        self.refresh()
+
+    def refresh(self):
+        self.textEdit.setPlainText(self.report())
@@ -157,6 +157,23 @@ class Editor(QsciScintilla):
     def getVScrollMaximum(self):
         return self.verticalScrollBar().maximum()
 
+    def getFirstVisibleDocLine(self):
+        """
+        first visible document line, 0-based. Fraction is the part of
+        a wrapped line which is scrolled out.
+        """
+        visible = self.firstVisibleLine()
+        line = self.SendScintilla(QsciScintilla.SCI_DOCLINEFROMVISIBLE, visible)
+        start = self.SendScintilla(QsciScintilla.SCI_VISIBLEFROMDOCLINE, line)
+        wraps = self.SendScintilla(QsciScintilla.SCI_WRAPCOUNT, line)
+        if wraps > 1:
+            return line + (visible - start) / wraps
+        return line
+
+    def setFirstVisibleDocLine(self, line):
+        visible = self.SendScintilla(QsciScintilla.SCI_VISIBLEFROMDOCLINE, int(line))
+        self.setFirstVisibleLine(visible)
+
     def getFileName(self):
         return self.filename
 
@@ -390,9 +407,12 @@ class Editor(QsciScintilla):
 
 class CodeViewer(Editor):
     """ code viewer, readonly """
+    _pending = None
+
     def __init__(self, *args, **kwargs):
         super(CodeViewer, self).__init__(*args, **kwargs)
         self.setReadOnly(True)
+        self.SendScintilla(QsciScintilla.SCI_SETUNDOCOLLECTION, False)
 
     def setValue(self, text):
         """ set all readonly text """
@@ -400,5 +420,65 @@ class CodeViewer(Editor):
         super(CodeViewer, self).setValue(text)
         self.setReadOnly(True)
 
+    def updateValue(self, text, filename):
+        """
+        text is shown when viewer is visible, only changed lines are
+        replaced and scroll position is kept.
+        """
+        self._pending = (text, filename)
+        if self.isVisible():
+            self.applyPending()
+
+    def showEvent(self, event):
+        super(CodeViewer, self).showEvent(event)
+        if self._pending:
+            self.applyPending()
+
+    def applyPending(self):
+        text, filename = self._pending
+        self._pending = None
+        first = self.firstVisibleLine()
+        hscroll = self.getHScrollValue()
+        self.setReadOnly(False)
+        self.replaceLines(toUtf8(text))
+        self.setReadOnly(True)
+        if filename != self.filename:
+            self.setFileName(filename)
+        self.setFirstVisibleLine(first)
+        self.horizontalScrollBar().setValue(hscroll)
+
+    def replaceLines(self, text):
+        """ replace lines between common head and tail lines """
+        old_lines = self.text().split('\n')
+        new_lines = text.split('\n')
+        count = min(len(old_lines), len(new_lines))
+        head = 0
+        while head < count - 1 and old_lines[head] == new_lines[head]:
+            head += 1
+        tail = 0
+        while tail < count - head - 1 and \
+                old_lines[-1 - tail] == new_lines[-1 - tail]:
+            tail += 1
+        if head == count - 1 and tail == 0 and \
+                len(old_lines) == len(new_lines) and \
+                old_lines[head] == new_lines[head]:
+            return
+        start = self.SendScintilla(QsciScintilla.SCI_POSITIONFROMLINE, head)
+        new_mid = new_lines[head:len(new_lines) - tail]
+        if tail:
+            end = self.SendScintilla(QsciScintilla.SCI_POSITIONFROMLINE,
+                                     len(old_lines) - tail)
+            data = ''.join(line + '\n' for line in new_mid)
+        else:
+            end = self.SendScintilla(QsciScintilla.SCI_GETLENGTH)
+            data = '\n'.join(new_mid)
+        data = data.encode('utf-8')
+        self.SendScintilla(QsciScintilla.SCI_SETTARGETRANGE, start, end)
+        self.SendScintilla(QsciScintilla.SCI_REPLACETARGET, len(data), data)
+        # lines are not split as in scintilla, such as single \r
+        if self.length() != len(text.encode('utf-8')):
+            logger.debug('Code viewer is reloaded')
+            self.setText(text)
+
     def find(self, finddialog, readonly=True):
         super(CodeViewer, self).find(finddialog, readonly)
@@ -0,0 +1,133 @@
+import logging
+import multiprocessing
+
+from rsteditor import output
+from rsteditor import highlight
+from rsteditor import dependency
+
+logger = logging.getLogger(__name__)
+
+# themes version of worker process, see ProcessExecutor.reloadThemes
+_themesVersion = 0
+
+
+def _warmup():
+    """ import docutils writers and pygments in worker process """
+    output.rst2htmlcode('warmup\n======\n\n.. code:: python\n\n   pass\n')
+
+
+def cache_stats():
+    """ statistics of render caches of this process """
+    return [
+        ('Renderer', dict(output.previewRenderer.stats)),
+        ('Highlight', highlight.tokenCache.stats()),
+        ('Math', output.mathCache.stats()),
+        ('Files', dependency.fileCache.stats()),
+    ]
+
+
+def _render(text, theme, pygments, settings, focus, source_path,
+            themes_version=0):
+    global _themesVersion
+    if themes_version != _themesVersion:
+        output.themeRegistry.update(force=True)
+        _themesVersion = themes_version
+    timings = {}
+    dependencies = []
+    html = output.rst2htmlcode(text, theme=theme, pygments=pygments,
+                               settings=settings, timings=timings,
+                               focus=focus, dependencies=dependencies,
+                               source_path=source_path)
+    return html, timings, dependencies, cache_stats()
+
+
+class ThreadExecutor(object):
+    """ render in the calling thread """
+    name = 'thread'
+
+    def render(self, text, theme='docutils', pygments='docutils', settings={},
+               timings=None, focus=None, dependencies=None,
+               source_path=None):
+        return output.rst2htmlcode(text, theme=theme, pygments=pygments,
+                                   settings=settings, timings=timings,
+                                   focus=focus, dependencies=dependencies,
+                                   source_path=source_path)
+
+    def reloadThemes(self):
+        output.themeRegistry.update(force=True)
+
+    def cacheStats(self):
+        return cache_stats()
+
+    def shutdown(self):
+        pass
+
+
+class ProcessExecutor(object):
+    """
+    render in preforked worker processes
+
+    docutils and pygments run out of the GUI process, only text and
+    theme names go to worker and html comes back.  Workers are started
+    and warmed up at once, the incremental render cache lives in them.
+    """
+    name = 'process'
+    # seconds, a stuck worker is killed and a new pool is started
+    render_timeout = 30
+
+    def __init__(self, workers=1):
+        self._workers = workers
+        self._themesVersion = 0
+        self._cacheStats = []
+        self._startPool()
+
+    def _startPool(self):
+        # don't fork a process with Qt threads
+        context = multiprocessing.get_context('spawn')
+        # workers replacing dead ones are warmed up too
+        self._pool = context.Pool(self._workers, initializer=_warmup)
+
+    def render(self, text, theme='docutils', pygments='docutils', settings={},
+               timings=None, focus=None, dependencies=None,
+               source_path=None):
+        try:
+            result = self._pool.apply_async(_render, (
+                text, theme, pygments, settings, focus, source_path,
+                self._themesVersion))
+            html, worker_timings, worker_dependencies, self._cacheStats = \
+                result.get(self.render_timeout)
+        except multiprocessing.TimeoutError:
+            # a render of a dead worker never ends either
+            logger.error('Render worker is stuck for %s s, restart it',
+                         self.render_timeout)
+            self._pool.terminate()
+            self._startPool()
+            # caches of new workers are empty
+            self._cacheStats = []
+            return 'Render is stopped after %s seconds' % self.render_timeout
+        if timings is not None:
+            timings.update(worker_timings)
+        if dependencies is not None:
+            dependencies.extend(worker_dependencies)
+        return html
+
+    def reloadThemes(self):
+        """ workers reload themes before next render """
+        output.themeRegistry.update(force=True)
+        self._themesVersion += 1
+
+    def cacheStats(self):
+        """ statistics of the worker which rendered last """
+        return self._cacheStats
+
+    def shutdown(self):
+        self._pool.close()
+
+
+def create(backend, workers=1):
+    if backend == ProcessExecutor.name:
+        try:
+            return ProcessExecutor(workers)
+        except (OSError, ValueError) as err:
+            logger.error('Could not start render worker: %s', err)
+    return ThreadExecutor()
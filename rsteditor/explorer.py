@@ -240,7 +240,6 @@ class Explorer(QtWidgets.QTreeWidget):
                 act.setChecked(True)
         self.clear()
         self.root_path = os.path.realpath(path)
-        os.chdir(path)
         self.root_item = self.addRoot(self.root_path)
         dirs = sorted(os.listdir(self.root_path), key=pathkey)
         for d in dirs:
@@ -0,0 +1,147 @@
+import os
+import queue
+import shutil
+import logging
+import tempfile
+import multiprocessing
+
+from PyQt5 import QtCore
+
+from rsteditor import output
+
+logger = logging.getLogger(__name__)
+
+# writer name of export kinds
+WRITERS = {
+    'html': 'html5',
+    'odt': 'odt',
+}
+
+
+def _export(kind, rst_file, temp_path, options, messages):
+    """
+    run in worker process, messages gets ('progress', percent, stage),
+    then ('done',) or ('error', text)
+    """
+    def progress(percent, stage):
+        messages.put(('progress', percent, stage))
+    try:
+        output.publish_file(WRITERS[kind], rst_file, temp_path,
+                            progress=progress, **options)
+    except BaseException as err:
+        messages.put(('error', str(err) or err.__class__.__name__))
+    else:
+        messages.put(('done',))
+
+
+class ExportJob(QtCore.QObject):
+    """
+    Export a rst file in a worker process.
+
+    The output is written to a temporary file beside the destination
+    and renamed to it when the worker succeeds, so a cancelled or
+    failed export leaves the old file untouched.
+    """
+    progress = QtCore.pyqtSignal(int, str)
+    # success, message
+    finished = QtCore.pyqtSignal(bool, str)
+    poll_interval = 100
+
+    def __init__(self, kind, rst_file, filename, parent=None, **options):
+        super(ExportJob, self).__init__(parent)
+        self.kind = kind
+        self.rst_file = rst_file
+        self.filename = filename
+        self.options = options
+        self._process = None
+        self._messages = None
+        self._temp_path = None
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(self.poll_interval)
+        self._timer.timeout.connect(self.onPoll)
+
+    def isRunning(self):
+        return self._process is not None
+
+    def start(self):
+        dirname, basename = os.path.split(os.path.abspath(self.filename))
+        fd, self._temp_path = tempfile.mkstemp(
+            suffix=os.path.splitext(basename)[1],
+            prefix='.%s.' % basename, dir=dirname)
+        os.close(fd)
+        # don't fork a process with Qt threads
+        context = multiprocessing.get_context('spawn')
+        self._messages = context.Queue()
+        process = context.Process(
+            target=_export,
+            args=(self.kind, self.rst_file, self._temp_path, self.options,
+                  self._messages),
+            daemon=True)
+        try:
+            process.start()
+        except OSError:
+            os.remove(self._temp_path)
+            self._temp_path = None
+            raise
+        self._process = process
+        self._timer.start()
+        logger.debug('Export %s to %s', self.rst_file, self.filename)
+
+    def cancel(self):
+        if not self.isRunning():
+            return
+        self._process.terminate()
+        self.finish(False, self.tr('Cancelled'))
+
+    def onPoll(self):
+        while self.isRunning():
+            try:
+                message = self._messages.get_nowait()
+            except queue.Empty:
+                if self._process.is_alive():
+                    return
+                try:
+                    # last message of exited worker may be in flight
+                    message = self._messages.get(timeout=1)
+                except queue.Empty:
+                    self.finish(False, self.tr('Export worker exited: %s') %
+                                self._process.exitcode)
+                    return
+            if message[0] == 'progress':
+                self.progress.emit(message[1], message[2])
+            elif message[0] == 'done':
+                self.commit()
+            else:
+                self.finish(False, message[1])
+
+    def commit(self):
+        try:
+            if os.path.exists(self.filename):
+                shutil.copymode(self.filename, self._temp_path)
+            else:
+                # mkstemp creates private file
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(self._temp_path, 0o666 & ~umask)
+            os.replace(self._temp_path, self.filename)
+        except OSError as err:
+            self.finish(False, str(err))
+            return
+        self._temp_path = None
+        self.finish(True, self.filename)
+
+    def finish(self, success, message):
+        self._timer.stop()
+        self._process.join(1)
+        self._process = None
+        self._messages.close()
+        self._messages = None
+        if self._temp_path:
+            try:
+                os.remove(self._temp_path)
+            except OSError as err:
+                logger.error(err)
+            self._temp_path = None
+        if not success:
+            logger.error('Export %s: %s', self.filename, message)
+        self.finished.emit(success, message)
@@ -0,0 +1,75 @@
+import logging
+import threading
+
+from docutils.parsers.rst.directives import body
+from docutils.utils import code_analyzer
+from docutils.utils.code_analyzer import LexerError
+
+from rsteditor.cache import LRUCache, hash_key
+
+logger = logging.getLogger(__name__)
+
+# tokens of highlighted code blocks, shared by all renders of the process
+tokenCache = LRUCache(8 * 1024 * 1024)
+
+_lexers = {}
+_lexersLock = threading.Lock()
+
+
+def get_lexer(alias):
+    """
+    pygments lexer of alias, lookups are cached including misses.
+    raise LexerError if no lexer is found
+    """
+    with _lexersLock:
+        if alias in _lexers:
+            lexer = _lexers[alias]
+        else:
+            try:
+                lexer = code_analyzer.get_lexer_by_name(alias)
+            except code_analyzer.pygments.util.ClassNotFound:
+                lexer = None
+            _lexers[alias] = lexer
+    if lexer is None:
+        raise LexerError('Cannot analyze code. '
+                         'No Pygments lexer found for "%s".' % alias)
+    return lexer
+
+
+class CachedLexer(code_analyzer.Lexer):
+    """
+    docutils Lexer reusing tokens of the same code, language and token names
+    """
+    def __init__(self, code, language, tokennames='short'):
+        self.code = code
+        self.language = language
+        self.tokennames = tokennames
+        self.lexer = None
+        if language in ('', 'text') or tokennames == 'none':
+            return
+        if not code_analyzer.with_pygments:
+            raise LexerError('Cannot analyze code. '
+                             'Pygments package not found.')
+        self.lexer = get_lexer(language)
+
+    def __iter__(self):
+        if self.lexer is None:
+            yield [], self.code
+            return
+        key = hash_key(self.language, self.tokennames, self.code)
+        tokens = tokenCache.get(key)
+        if tokens is None:
+            tokens = [(tuple(classes), value) for classes, value in
+                      super(CachedLexer, self).__iter__()]
+            # rough size: text plus a tuple per token
+            tokenCache.put(key, tokens, len(self.code) * 2 + len(tokens) * 64)
+        for classes, value in tokens:
+            yield list(classes), value
+
+
+def register():
+    """
+    code directive of docutils highlights through CachedLexer,
+    see output.py
+    """
+    body.Lexer = CachedLexer
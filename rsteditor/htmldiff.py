@@ -0,0 +1,142 @@
+"""
+Changes between two html pages of preview as patches of top level
+elements, the page is patched in place instead of loaded again.
+"""
+import re
+
+HEAD = re.compile(r'<head[^>]*>(.*?)</head>', re.S | re.I)
+BODY = re.compile(r'<body[^>]*>(.*)</body>', re.S | re.I)
+TAG = re.compile(r'<!--.*?-->|<(/?)([a-zA-Z][^\s/>]*)[^>]*?(/?)>', re.S)
+VOID_TAGS = set([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr',
+])
+# content of raw elements is text up to their closing tag
+RAW_TAGS = {
+    'script': re.compile(r'</script\s*>', re.I),
+    'style': re.compile(r'</style\s*>', re.I),
+}
+# elements which are patched by their children
+CONTAINER_TAGS = set(['main', 'section', 'div', 'aside', 'article', 'body'])
+# line map of preview, written by output.source_line_translator_class
+LINE_MAP = re.compile(
+    r'(<script type="application/json" id="rsteditor-lines">)([^<]*)</script>')
+
+
+def split_line_map(html):
+    """
+    html with empty line map and the line map. The line map changes with
+    every inserted or deleted line, it is updated apart from the patches.
+    """
+    mo = LINE_MAP.search(html)
+    if not mo:
+        return html, None
+    return html[:mo.start(2)] + html[mo.end(2):], mo.group(2)
+
+
+def split_elements(html, start=0, end=None):
+    """
+    top level elements in html[start:end]
+    result: [(tag, start, inner_start, inner_end, end), ...]
+    """
+    if end is None:
+        end = len(html)
+    elements = []
+    depth = 0
+    current = None
+    pos = start
+    while True:
+        mo = TAG.search(html, pos, end)
+        if not mo:
+            break
+        pos = mo.end()
+        closing, tag, selfclosing = mo.group(1), mo.group(2), mo.group(3)
+        if tag is None:     # comment
+            continue
+        tag = tag.lower()
+        if closing:
+            depth -= 1
+            if depth == 0 and current:
+                elements.append((current[0], current[1], current[2],
+                                 mo.start(), mo.end()))
+                current = None
+            elif depth < 0:
+                return None
+            continue
+        if tag in RAW_TAGS:
+            close = RAW_TAGS[tag].search(html, pos, end)
+            if not close:
+                return None
+            if depth == 0:
+                elements.append((tag, mo.start(), pos,
+                                 close.start(), close.end()))
+            pos = close.end()
+            continue
+        if selfclosing or tag in VOID_TAGS:
+            if depth == 0:
+                elements.append((tag, mo.start(), mo.end(),
+                                 mo.end(), mo.end()))
+            continue
+        if depth == 0:
+            current = (tag, mo.start(), mo.end())
+        depth += 1
+    if depth != 0:
+        return None
+    return elements
+
+
+def diff_html(old, new):
+    """
+    result: None if page must be reloaded, or
+            [(element path, start, remove count, html, child count), ...]
+    """
+    old_head = HEAD.search(old)
+    new_head = HEAD.search(new)
+    if not old_head or not new_head or \
+            old_head.group(1) != new_head.group(1):
+        return None
+    old_body = BODY.search(old)
+    new_body = BODY.search(new)
+    if not old_body or not new_body:
+        return None
+    patches = []
+    if not diff_elements(
+            old, old_body.start(1), old_body.end(1),
+            new, new_body.start(1), new_body.end(1),
+            [], patches):
+        return None
+    return patches
+
+def diff_elements(old, old_start, old_end, new, new_start, new_end,
+                  path, patches):
+    old_elements = split_elements(old, old_start, old_end)
+    new_elements = split_elements(new, new_start, new_end)
+    if old_elements is None or new_elements is None:
+        return False
+    old_texts = [old[e[1]:e[4]] for e in old_elements]
+    new_texts = [new[e[1]:e[4]] for e in new_elements]
+    prefix = 0
+    while (prefix < len(old_texts) and prefix < len(new_texts) and
+           old_texts[prefix] == new_texts[prefix]):
+        prefix += 1
+    suffix = 0
+    while (suffix < len(old_texts) - prefix and
+           suffix < len(new_texts) - prefix and
+           old_texts[-1 - suffix] == new_texts[-1 - suffix]):
+        suffix += 1
+    old_count = len(old_texts) - prefix - suffix
+    new_count = len(new_texts) - prefix - suffix
+    if old_count == 0 and new_count == 0:
+        return True
+    if old_count == 1 and new_count == 1:
+        old_e = old_elements[prefix]
+        new_e = new_elements[prefix]
+        # same element with changed children
+        if old_e[0] == new_e[0] and old_e[0] in CONTAINER_TAGS and \
+                old[old_e[1]:old_e[2]] == new[new_e[1]:new_e[2]]:
+            return diff_elements(
+                old, old_e[2], old_e[3], new, new_e[2], new_e[3],
+                path + [prefix], patches)
+    fragment = ''.join(new_texts[prefix:prefix + new_count])
+    patches.append((path, prefix, old_count, fragment, len(new_texts)))
+    return True
@@ -0,0 +1,645 @@
+import re
+import bisect
+import pickle
+import logging
+import threading
+import itertools
+from collections import OrderedDict
+
+from docutils import nodes
+from docutils import utils
+
+from rsteditor import dependency
+from rsteditor.cache import hash_key
+from rsteditor.timing import measure
+
+logger = logging.getLogger(__name__)
+
+# line consisting of one repeated punctuation character
+ADORNMENT = re.compile(r'''([!-/:-@\[-`{-~])\1* *$''')
+# parse-time state which is shared by the whole document
+CONTEXT_DIRECTIVE = re.compile(r'''^\.\. +(role|default-role)::''')
+# converted to space by the rst parser before splitting lines
+WHITESPACE = re.compile(r'''[\v\f]''')
+# identifier generated by docutils
+AUTO_ID = re.compile(r'''^(.*?)(\d+)$''')
+
+# document attributes which are not node registries
+NOT_REGISTRY = set([
+    'settings', 'reporter', 'transformer', 'decoration',
+    'current_source', 'current_line', 'id_counter',
+    'autofootnote_start', 'symbol_footnote_start',
+    'ids', 'names', 'nameids', 'nametypes', 'refids',
+    'children', 'attributes', 'parent', 'rawsource', 'tagname',
+    'source', 'line', 'document', '_document',
+])
+# registries which are merged by name
+NAME_REGISTRY = set(['ids', 'names', 'nameids', 'nametypes', 'refids'])
+
+
+def iter_nodes(node):
+    """ all nodes of the tree in document order, node itself included """
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        children = getattr(node, 'children', None)
+        if children:
+            stack.extend(reversed(children))
+
+
+def source_lines(text):
+    """
+    lines of text numbered as the rst parser does,
+    tabs are left for the parser
+    """
+    return WHITESPACE.sub(' ', text).splitlines()
+
+
+def scan_titles(lines):
+    """
+    Find section titles without parsing.
+    result: [(first line of title, style), ...]
+    """
+    titles = []
+    count = len(lines)
+    x = 0
+    while x < count - 1:
+        line = lines[x]
+        if not line.strip() or (x > 0 and lines[x - 1].strip()):
+            x += 1
+            continue
+        mo = ADORNMENT.match(line)
+        if mo:
+            # overline and underline
+            if (x + 2 < count and lines[x + 1].strip() and
+                    len(line.rstrip()) >= 4 and
+                    lines[x + 2].rstrip() == line.rstrip()):
+                titles.append((x, (line[0], line[0])))
+                x += 3
+                continue
+        elif not line[0].isspace():
+            under = lines[x + 1]
+            mu = ADORNMENT.match(under)
+            if mu and (len(under.rstrip()) >= 4 or
+                       len(under.rstrip()) >= len(line.rstrip())):
+                titles.append((x, (under[0],)))
+                x += 2
+                continue
+        x += 1
+    return titles
+
+
+def title_start(lines, line):
+    """
+    first line of section title whose underline is at line,
+    line numbers start at 1 as in docutils
+    """
+    x = line - 1
+    if x >= 2 and ADORNMENT.match(lines[x - 2]) and \
+            lines[x - 2].rstrip() == lines[x].rstrip():
+        return line - 2
+    return line - 1
+
+
+def title_styles(titles):
+    styles = []
+    for _, style in titles:
+        if style not in styles:
+            styles.append(style)
+    return styles
+
+
+class holder(nodes.Element):
+    """
+    Targets and references of a section out of focus.  Document-wide
+    transforms resolve and number them as in the full document, such as
+    pairing of anonymous references.  Holders are removed before writing.
+    """
+
+
+class held(nodes.TextElement):
+    """ node in holder, block targets in text elements aren't propagated """
+
+
+def propagated_to(target):
+    """ node which target is propagated to, as PropagateTargets """
+    if isinstance(target.parent, nodes.TextElement) or \
+            target.hasattr('refid') or target.hasattr('refuri') or \
+            target.hasattr('refname'):
+        return None
+    next_node = target.next_node(ascend=True)
+    while isinstance(next_node, nodes.system_message):
+        next_node = next_node.next_node(ascend=True, descend=False)
+    if next_node is None or \
+            isinstance(next_node, (nodes.Invisible, nodes.Targetable)) and \
+            not isinstance(next_node, nodes.target):
+        return None
+    return next_node
+
+
+def make_holder(tree, copy):
+    """
+    holder of tree in document order.
+    copy: function returning node without children
+    """
+    node_holder = holder()
+    done = set()
+    for node in iter_nodes(tree):
+        if id(node) in done:
+            continue
+        if isinstance(node, (nodes.reference, nodes.substitution_reference)):
+            node_holder.append(held('', '', copy(node)))
+        elif isinstance(node, nodes.target):
+            chain = [node]
+            next_node = propagated_to(node)
+            while isinstance(next_node, nodes.target):
+                chain.append(next_node)
+                next_node = propagated_to(next_node)
+            if next_node is None:
+                node_holder.append(held('', '', copy(node)))
+                continue
+            # target with the node which it is propagated to
+            chain.append(next_node)
+            done.update(id(n) for n in chain)
+            node_holder.append(nodes.Element('', *[copy(n) for n in chain]))
+    return node_holder
+
+
+def copy_node(node):
+    """copy keeping the source position for system messages"""
+    copy = node.copy()
+    copy.source, copy.line = utils.get_source_line(node)
+    return copy
+
+
+def remove_holders(document):
+    for node in list(document.findall(holder)):
+        node.parent.remove(node)
+
+
+class Chunk(object):
+    """ document text from one section title to the next one """
+    def __init__(self, start, lines, level, context=''):
+        self.start = start
+        self.text = '\n'.join(lines) + '\n'
+        # section level, 0 is the text before first title
+        self.level = level
+        self.context = context
+        self.offset = start - context.count('\n')
+
+    def key(self, signature):
+        return hash_key(signature, self.context, self.text)
+
+
+class IncrementalRenderer(object):
+    """
+    Render reStructuredText section by section.
+
+    The document is split at section titles. Every section is parsed
+    alone and its doctree is cached by content hash, so a render only
+    parses the sections which have been changed.  The sections are
+    merged into one document and document-wide transforms (contents,
+    footnotes, references, ...) and the writer run on the whole tree.
+    A cached section is parsed again if a file it includes is changed.
+    """
+    cache_size = 1024
+    # don't split documents with less sections
+    min_chunks = 3
+    # sections kept before and after the focused one
+    focus_neighbours = 1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self.stats = {
+            'parsed': 0,
+            'reused': 0,
+            'fallback': 0,
+            'pruned': 0,
+            'changed': 0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def render(self, text, context, timings=None, focus=None,
+               dependencies=None, source_path=None):
+        """
+        context: output.RenderContext, settings and writer of render
+        timings: dict, seconds of parse, transform and write are added
+        focus: source line, only its top level section and neighbours
+               are written
+        dependencies: list, snapshot of files read by directives is added
+        source_path: path of document, relative paths are based on it
+        """
+        with measure(timings, 'parse'):
+            pub = context.publisher(text, source_path)
+            # sections of other documents include other files
+            signature = hash_key(context.signature, source_path)
+            with self._lock:
+                document = self.parse(pub, text, signature, focus)
+            if document is None:
+                self.stats['fallback'] += 1
+                document = pub.reader.read(pub.source, pub.parser, pub.settings)
+                if focus is not None:
+                    self.prune(document, focus, source_lines(text))
+        pub.document = document
+        with measure(timings, 'transform'):
+            pub.apply_transforms()
+            if focus is not None:
+                remove_holders(document)
+        with measure(timings, 'write'):
+            output = pub.writer.write(pub.document, pub.destination)
+            pub.writer.assemble_parts()
+        # embedded stylesheets are recorded by writer
+        if dependencies is not None:
+            dependencies.extend(dependency.snapshot(
+                pub.settings.record_dependencies.list))
+        return output
+
+    def split(self, text):
+        """ result: [chunk, ...] """
+        lines = source_lines(text)
+        titles = scan_titles(lines)
+        styles = title_styles(titles)
+        bounds = [(0, 0)]
+        for start, style in titles:
+            if start == 0:
+                bounds.pop()
+            bounds.append((start, styles.index(style) + 1))
+        bounds.append((len(lines), 0))
+        chunks = []
+        context = []
+        for (start, level), (end, _) in zip(bounds[:-1], bounds[1:]):
+            chunks.append(Chunk(
+                start, lines[start:end], level,
+                '\n'.join(context) + '\n\n' if context else ''))
+            context.extend(self.getContext(lines[start:end]))
+        return chunks
+
+    def getContext(self, lines):
+        """ role directives in chunk, they are needed by next chunks """
+        context = []
+        directive = False
+        for line in lines:
+            if CONTEXT_DIRECTIVE.match(line):
+                directive = True
+            elif directive and not (line and line[0].isspace()):
+                directive = False
+            if directive:
+                context.append(line)
+        return context
+
+    def parse(self, pub, text, signature, focus=None):
+        chunks = self.split(text)
+        if len(chunks) < self.min_chunks:
+            return None
+        keep = self.focusChunks(chunks, focus) if focus is not None else None
+        document = utils.new_document(pub.source.source_path, pub.settings)
+        # open sections, parents of next chunk
+        sections = [document]
+        for x, chunk in enumerate(chunks):
+            key = chunk.key(signature)
+            data = self._cache.get(key)
+            if data and dependency.changed(data[2]):
+                data = None
+                self.stats['changed'] += 1
+            if data:
+                self._cache.move_to_end(key)
+                self.stats['reused'] += 1
+                pub.settings.record_dependencies.add(
+                    *[path for path, _ in data[2]])
+            else:
+                data = self.parseChunk(pub, chunk)
+                if data is None:
+                    return None
+                self._cache[key] = data
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+                self.stats['parsed'] += 1
+            if keep is not None and x not in keep:
+                # only registries of chunk out of focus
+                stub, placeholders, chunk_holder = pickle.loads(data[1])
+                # transforms may replace them, a parent is needed
+                nodes.Element('', *[node for node in placeholders
+                                    if node.parent is None])
+                shared = set(map(id, placeholders))
+                placeholders.extend(node for node in iter_nodes(chunk_holder)
+                                    if id(node) not in shared)
+                if self.hasDuplicates(document, stub, chunk):
+                    return None
+                self.merge(document, document, stub, [], chunk.offset,
+                           placeholders)
+                level = min(chunk.level, len(sections))
+                sections[level - 1 if level else 0].append(chunk_holder)
+                self.stats['pruned'] += 1
+                continue
+            chunk_doc, pendings = pickle.loads(data[0])
+            if chunk.level:
+                if chunk.level > len(sections):
+                    logger.debug('Inconsistent title level at line %s',
+                                 chunk.start + 1)
+                    return None
+                section = self.getSection(chunk_doc)
+                if section is None:
+                    logger.debug('Not a section at line %s', chunk.start + 1)
+                    return None
+                del sections[chunk.level:]
+                sections.append(section)
+                parent = sections[chunk.level - 1]
+            else:
+                parent = document
+            if self.hasDuplicates(document, chunk_doc, chunk):
+                return None
+            self.merge(document, parent, chunk_doc, pendings, chunk.offset)
+        return document
+
+    def focusRange(self, starts, line):
+        """
+        (first, last) indexes of top level sections written around line,
+        None if all sections are written.
+        starts: first source line of every top level section
+        """
+        if len(starts) <= 2 * self.focus_neighbours + 1:
+            return None
+        index = max(0, bisect.bisect_right(starts, line) - 1)
+        return (max(0, index - self.focus_neighbours),
+                index + self.focus_neighbours)
+
+    def focusChunks(self, chunks, line):
+        """
+        indexes of chunks in top level sections around line and chunks
+        of their parent sections, None if all chunks are needed.
+        """
+        levels = [chunk.level for chunk in chunks]
+        level = 1
+        while levels.count(level) == 1:
+            # document title or one chapter
+            level += 1
+        tops = [x for x, chunk in enumerate(chunks) if chunk.level == level]
+        focus = self.focusRange([chunks[x].start + 1 for x in tops], line)
+        if focus is None:
+            return None
+        first = tops[focus[0]]
+        end = tops[focus[1] + 1] if focus[1] + 1 < len(tops) else len(chunks)
+        keep = set(range(first, end))
+        keep.update(x for x, chunk in enumerate(chunks) if chunk.level < level)
+        return keep
+
+    def prune(self, document, line, lines):
+        """
+        replace top level sections far from line with holders before
+        transforms.  Registries of document are kept, so references to
+        removed sections, footnotes and substitutions are still resolved.
+        lines: source lines of document
+        """
+        container = document
+        while True:
+            sections = [child for child in container.children
+                        if isinstance(child, nodes.section)]
+            if len(sections) != 1:
+                break
+            # document title or one chapter
+            container = sections[0]
+        starts = []
+        for section in sections:
+            start = section[0].line if len(section) else None
+            if start:
+                start = title_start(lines, start)
+            starts.append(start or (starts[-1] if starts else 0))
+        focus = self.focusRange(starts, line)
+        if focus is None:
+            return
+        removed = set()
+        for x, section in enumerate(sections):
+            if x < focus[0] or x > focus[1]:
+                container.replace(section, make_holder(section, copy_node))
+                removed.add(id(section))
+        # pending transforms in removed sections
+        transforms = []
+        for entry in document.transformer.transforms:
+            node = entry[2]
+            while node is not None and id(node) not in removed:
+                node = node.parent
+            if node is None:
+                transforms.append(entry)
+        document.transformer.transforms[:] = transforms
+        self.stats['pruned'] += len(removed)
+
+    def getSection(self, chunk_doc):
+        """ the section starts chunk, only moved nodes are before it """
+        for child in chunk_doc.children:
+            if isinstance(child, nodes.section):
+                return child
+            if child is not chunk_doc.decoration and \
+                    not isinstance(child, nodes.meta):
+                return None
+        return None
+
+    def parseChunk(self, pub, chunk):
+        """
+        result: (pickled document and pendings, pickled stub,
+                 snapshot of files read by chunk)
+        """
+        settings = pub.settings
+        document = utils.new_document(pub.source.source_path, settings)
+        # files of this chunk only, the render list skips known ones
+        recorder = settings.record_dependencies
+        settings.record_dependencies = utils.DependencyList()
+        try:
+            pub.reader.parser.parse(chunk.context + chunk.text, document)
+        finally:
+            paths = settings.record_dependencies.list
+            settings.record_dependencies = recorder
+        recorder.add(*paths)
+        files = dependency.snapshot(paths)
+        document.current_source = document.current_line = None
+        pendings = []
+        for priority, _, pending, _ in document.transformer.transforms:
+            pendings.append((int(priority.split('-')[0]), pending))
+        try:
+            return (
+                pickle.dumps((document, pendings), pickle.HIGHEST_PROTOCOL),
+                pickle.dumps(self.makeStub(document), pickle.HIGHEST_PROTOCOL),
+                files,
+            )
+        except (pickle.PicklingError, TypeError, AttributeError) as err:
+            logger.debug('Chunk %s could not be cached: %s', chunk.start, err)
+            return None
+
+    def makeStub(self, document):
+        """
+        document without children for chunks out of focus. Registered
+        nodes are replaced by copies without children.
+        result: (stub document, [placeholder, ...], holder)
+        """
+        copies = OrderedDict()
+
+        def convert(value):
+            if isinstance(value, nodes.Node):
+                if id(value) not in copies:
+                    if isinstance(value, nodes.substitution_definition):
+                        copy = value.deepcopy()
+                    else:
+                        copy = copy_node(value)
+                    # don't pickle the whole chunk with placeholder
+                    for node in iter_nodes(copy):
+                        node.document = None
+                    copies[id(value)] = copy
+                return copies[id(value)]
+            if isinstance(value, list):
+                return [convert(v) for v in value]
+            if isinstance(value, dict):
+                return dict((k, convert(v)) for k, v in value.items())
+            return value
+
+        stub = document.copy()
+        for attr, value in vars(document).items():
+            if attr in NOT_REGISTRY and attr not in NAME_REGISTRY:
+                continue
+            setattr(stub, attr, convert(value))
+        chunk_holder = make_holder(document, convert)
+        return stub, list(copies.values()), chunk_holder
+
+    def hasDuplicates(self, document, chunk_doc, chunk):
+        """
+        names of chunk which docutils reports as duplicate in the whole
+        document, the report is made while parsing.
+        """
+        duplicates = [name for name in chunk_doc.substitution_defs
+                      if name in document.substitution_defs]
+        duplicates.extend(name for name, explicit in chunk_doc.nametypes.items()
+                          if explicit and document.nametypes.get(name))
+        if duplicates:
+            logger.debug('Duplicate name %r at line %s',
+                         duplicates[0], chunk.start + 1)
+        return bool(duplicates)
+
+    def merge(self, document, parent, chunk_doc, pendings, offset,
+              placeholders=()):
+        """ move parsed chunk into document """
+        renames = self.renumberIds(document, chunk_doc, placeholders)
+        for node in itertools.chain(iter_nodes(chunk_doc), placeholders):
+            node.document = document
+            if node.line:
+                node.line += offset
+            if not isinstance(node, nodes.Element):
+                continue
+            if isinstance(node, nodes.system_message) and node.get('line'):
+                node['line'] += offset
+            if renames:
+                for attr in ('ids', 'backrefs'):
+                    if node.get(attr):
+                        node[attr] = [renames.get(v, v) for v in node[attr]]
+                if node.get('refid') in renames:
+                    node['refid'] = renames[node['refid']]
+        for node_id, node in chunk_doc.ids.items():
+            document.ids[renames.get(node_id, node_id)] = node
+        for node_id, refs in chunk_doc.refids.items():
+            document.refids.setdefault(
+                renames.get(node_id, node_id), []).extend(refs)
+        self.mergeNames(document, chunk_doc, renames)
+        for attr, value in vars(chunk_doc).items():
+            if attr in NOT_REGISTRY:
+                continue
+            old = getattr(document, attr, None)
+            if isinstance(value, list) and isinstance(old, list):
+                old.extend(value)
+            elif isinstance(value, dict) and isinstance(old, dict):
+                for k, v in value.items():
+                    if isinstance(v, list):
+                        old.setdefault(k, []).extend(v)
+                    else:
+                        old.setdefault(k, v)
+        if 'title' in chunk_doc:
+            document['title'] = chunk_doc['title']
+        for child in list(chunk_doc.children):
+            if child is chunk_doc.decoration:
+                decoration = document.get_decoration()
+                for part in child.children:
+                    if isinstance(part, nodes.header):
+                        decoration.get_header().extend(part.children)
+                    elif isinstance(part, nodes.footer):
+                        decoration.get_footer().extend(part.children)
+                continue
+            if isinstance(child, nodes.meta):
+                # meta directive inserts at begin of document
+                index = document.first_child_not_matching_class(
+                    (nodes.Titular, nodes.meta)) or 0
+                document.insert(index, child)
+                continue
+            parent.append(child)
+        for priority, pending in pendings:
+            document.transformer.add_pending(pending, priority)
+
+    def renumberIds(self, document, chunk_doc, placeholders=()):
+        """
+        Generated identifiers are numbered again in merged document,
+        conflicted identifiers are renamed.
+        result: { old_id: new_id, ... }
+        """
+        renames = {}
+        auto_ids = []
+        id_prefix = document.settings.id_prefix
+        for node in itertools.chain(iter_nodes(chunk_doc), placeholders):
+            if not isinstance(node, nodes.Element) or not node['ids']:
+                continue
+            named = set(id_prefix + nodes.make_id(name)
+                        for name in node['names'] + node['dupnames'])
+            for node_id in node['ids']:
+                mo = AUTO_ID.match(node_id)
+                if mo and node_id not in named:
+                    auto_ids.append((mo.group(1), int(mo.group(2)), node_id))
+                elif node_id in document.ids:
+                    renames[node_id] = self.newId(document, node_id)
+        for prefix, _, node_id in sorted(auto_ids):
+            renames[node_id] = self.newId(document, node_id, prefix)
+        return renames
+
+    def newId(self, document, node_id, prefix=None):
+        settings = document.settings
+        if prefix is None:
+            if settings.auto_id_prefix.endswith('%'):
+                prefix = node_id + '-'
+            else:
+                prefix = settings.id_prefix + settings.auto_id_prefix
+        while True:
+            document.id_counter[prefix] += 1
+            new_id = '%s%s' % (prefix, document.id_counter[prefix])
+            if new_id not in document.ids:
+                return new_id
+
+    def mergeNames(self, document, chunk_doc, renames):
+        """
+        merge target names, conflicts are resolved as in docutils:
+        explicit target overrides implicit one, others are ambiguous.
+        """
+        for name, node_id in chunk_doc.nameids.items():
+            node_id = renames.get(node_id, node_id)
+            explicit = chunk_doc.nametypes.get(name, False)
+            node = chunk_doc.names.get(name)
+            if name not in document.nameids:
+                document.nameids[name] = node_id
+                document.nametypes[name] = explicit
+                document.names[name] = node
+                continue
+            old_explicit = document.nametypes.get(name, False)
+            old_node = document.names.get(name)
+            if explicit and not old_explicit:
+                document.nameids[name] = node_id
+                document.names[name] = node
+                self.dupname(old_node, name)
+            elif old_explicit and not explicit:
+                self.dupname(node, name)
+            else:
+                document.nameids[name] = None
+                document.names[name] = None
+                self.dupname(old_node, name)
+                self.dupname(node, name)
+            document.nametypes[name] = old_explicit or explicit
+
+    def dupname(self, node, name):
+        if node is not None and name in node['names']:
+            nodes.dupname(node, name)
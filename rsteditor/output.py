@@ -1,35 +1,70 @@
 import os.path
+import re
+import copy
+import bisect
+import time
 import logging
 import json
+import threading
 from collections import OrderedDict
 
 try:
-    from docutils.core import publish_string
-    from docutils.core import publish_cmdline
-    from docutils.core import publish_cmdline_to_binary
+    import docutils
+    from docutils import nodes
+    from docutils import utils
+    from docutils import io as docutils_io
+    from docutils.core import Publisher
     from docutils.writers.odf_odt import Writer, Reader
     from docutils.writers import html5_polyglot
 except:
     raise Exception('Please install docutils firstly')
 
 from rsteditor import __data_path__, __home_data_path__
+from rsteditor import incremental
+from rsteditor import highlight
+from rsteditor import dependency
+from rsteditor.cache import LRUCache, hash_key
 
 logger = logging.getLogger(__name__)
 
+# docutils has one directive registry per process, not per document or
+# publisher.  Directives and the lexer of code blocks are replaced once at
+# import, so preview and export always parse with the same ones.  They
+# give the same nodes as docutils and only add caching and dependency
+# recording.
+highlight.register()
+dependency.register()
+
+# preview renderer, keeps parsed sections between renders
+previewRenderer = incremental.IncrementalRenderer()
+
 default_overrides = {
     'input_encoding': 'utf-8',
     'output_encoding': 'utf-8',
 }
 
+# cheap preview while typing: no pygments and no math conversion.
+# Stylesheets are embedded as in final renders, the same <head> lets the
+# preview patch the body instead of reloading the page.
+draft_overrides = {
+    'syntax_highlight': 'none',
+    'math_output': 'LaTeX',
+}
 
-def get_themes():
+# math output modes of preview, see get_math_overrides
+math_outputs = OrderedDict([
+    ('html', 'HTML+CSS'),
+    ('mathml', 'MathML'),
+])
+
+# converted math of html and mathml output, shared by all renders
+mathCache = LRUCache(4 * 1024 * 1024)
+
+
+def load_themes(themes_dirs):
     """
     result: { 'theme': theme_dict, ... }
     """
-    themes_dirs = [
-        os.path.join(__home_data_path__, 'themes'),
-        os.path.join(__data_path__, 'themes'),
-    ]
     themes = OrderedDict()
     for themes_dir in themes_dirs:
         if os.path.exists(themes_dir):
@@ -47,97 +82,500 @@ def get_themes():
     return themes
 
 
-def get_theme_settings(theme, pygments):
-    """
-    1. pygments.css has been created in app.py so parameter pygments is unused.
-    2. docutils writer will load css file.
-    """
-    stylesheet = {}
+def get_docutils_theme_path():
     search_paths = [
         '/usr/share/docutils/writers',
         os.path.abspath(os.path.dirname(os.path.dirname(html5_polyglot.__file__))),
         os.path.abspath(os.path.join(__data_path__, 'docutils', 'writers')),
     ]
-    docutils_theme_path = ''
     for path in search_paths:
         if os.path.exists(os.path.join(path, 'html5_polyglot', 'template.txt')):
-            docutils_theme_path = path
-            break
-    stylesheet['stylesheet_dirs'] = [
-        os.path.join(docutils_theme_path, 'html4css1'),
-        os.path.join(docutils_theme_path, 'html5_polyglot'),
-    ]
+            return path
+    return ''
 
-    pygments_path = os.path.join(__home_data_path__, 'themes', 'pygments.css')
-    if os.path.exists(pygments_path):
-        stylesheet['stylesheet_path'] = pygments_path
-        stylesheet['syntax_highlight'] = 'short'
 
-    # docutils default theme
-    if theme == 'docutils':
+class ThemeRegistry(object):
+    """
+    Themes and their docutils settings, loaded once.
+
+    Modification time of theme directories, theme.json and pygments.css
+    is checked at most every ``check_interval`` seconds and the registry
+    is rebuilt only when something has been changed.  Call update with
+    force after writing one of them.
+    """
+    check_interval = 2.0
+
+    def __init__(self, themes_dirs, pygments_path):
+        self.themes_dirs = themes_dirs
+        self.pygments_path = pygments_path
+        self.docutils_theme_path = get_docutils_theme_path()
+        self._lock = threading.Lock()
+        self._signature = None
+        self._checked = None
+        # increased when themes are reloaded
+        self.version = 0
+        self._themes = OrderedDict()
+        self._settings = {}
+
+    def signature(self):
+        """ modification time of files which themes are loaded from """
+        paths = [self.pygments_path]
+        for themes_dir in self.themes_dirs:
+            paths.append(themes_dir)
+            if os.path.isdir(themes_dir):
+                for theme in sorted(os.listdir(themes_dir)):
+                    paths.append(os.path.join(themes_dir, theme, 'theme.json'))
+        return [(path, dependency.stat_key(path)) for path in paths]
+
+    def update(self, force=False):
+        now = time.monotonic()
+        with self._lock:
+            if not force and self._checked is not None and \
+                    now - self._checked < self.check_interval:
+                return
+            self._checked = now
+            signature = self.signature()
+            if signature == self._signature:
+                return
+            logger.debug('Loading themes')
+            self._signature = signature
+            self.version += 1
+            self._themes = load_themes(self.themes_dirs)
+            self._settings = {'docutils': self.resolve('docutils')}
+            for theme in self._themes:
+                self._settings[theme] = self.resolve(theme)
+
+    def resolve(self, theme):
+        """
+        1. pygments.css has been created in app.py
+        2. docutils writer will load css file.
+        """
+        stylesheet = {}
+        stylesheet['stylesheet_dirs'] = [
+            os.path.join(self.docutils_theme_path, 'html4css1'),
+            os.path.join(self.docutils_theme_path, 'html5_polyglot'),
+        ]
+
+        if os.path.exists(self.pygments_path):
+            stylesheet['stylesheet_path'] = self.pygments_path
+            stylesheet['syntax_highlight'] = 'short'
+
+        # docutils default theme
+        if theme == 'docutils':
+            return stylesheet
+
+        # third part theme
+        styles = self._themes.get(theme)
+
+        # stylesheet_path : css file path
+        # syntax_highlight: short
+        # template: template file path
+        stylesheet['stylesheet_dirs'].extend(styles['stylesheet_dirs'])
+        if 'syntax_highlight' in styles:
+            stylesheet['syntax_highlight'] = styles['syntax_highlight']
+        if 'stylesheet_path' in styles:
+            css_paths = styles['stylesheet_path'].split(',')
+            if 'stylesheet_path' in stylesheet:
+                css_paths += stylesheet['stylesheet_path'].split(',')
+            stylesheet['stylesheet_path'] = ','.join(css_paths)
+        if 'template' in styles:
+            old_path = styles['template']
+            new_path = os.path.abspath(
+                os.path.join(__home_data_path__,
+                             'themes',
+                             theme,
+                             old_path))
+            stylesheet['template'] = new_path
         return stylesheet
 
-    # third part theme
-    themes = get_themes()
-    styles = themes.get(theme)
-
-    # stylesheet_path : css file path
-    # syntax_highlight: short
-    # template: template file path
-    stylesheet['stylesheet_dirs'].extend(styles['stylesheet_dirs'])
-    if 'syntax_highlight' in styles:
-        stylesheet['syntax_highlight'] = styles['syntax_highlight']
-    if 'stylesheet_path' in styles:
-        css_paths = styles['stylesheet_path'].split(',')
-        if 'stylesheet_path' in stylesheet:
-            css_paths += stylesheet['stylesheet_path'].split(',')
-        stylesheet['stylesheet_path'] = ','.join(css_paths)
-    if 'template' in styles:
-        old_path = styles['template']
-        new_path = os.path.abspath(
-            os.path.join(__home_data_path__,
-                         'themes',
-                         theme,
-                         old_path))
-        stylesheet['template'] = new_path
-    return stylesheet
-
-
-def rst2htmlcode(rst_text, theme='docutils', pygments='docutils', settings={}):
+    def themes(self):
+        self.update()
+        return self._themes
+
+    def settings(self, theme):
+        """ return a copy of theme settings """
+        self.update()
+        stylesheet = self._settings.get(theme)
+        if stylesheet is None:
+            raise KeyError('Unknown theme: %s' % theme)
+        stylesheet = dict(stylesheet)
+        stylesheet['stylesheet_dirs'] = list(stylesheet['stylesheet_dirs'])
+        return stylesheet
+
+
+themeRegistry = ThemeRegistry(
+    [
+        os.path.join(__home_data_path__, 'themes'),
+        os.path.join(__data_path__, 'themes'),
+    ],
+    os.path.join(__home_data_path__, 'themes', 'pygments.css'),
+)
+
+
+def get_math_assets_path():
+    """ local directory of math stylesheets, no network is needed """
+    return os.path.join(themeRegistry.docutils_theme_path, 'html5_polyglot')
+
+
+def get_math_stylesheet():
+    return os.path.join(get_math_assets_path(), 'math.css')
+
+
+def is_math_asset(path):
+    return os.path.abspath(path) == get_math_stylesheet()
+
+
+def get_math_overrides(mode):
+    """
+    mode: html or mathml, see math_outputs
+    """
+    if mode == 'mathml':
+        return {'math_output': 'MathML'}
+    return {'math_output': 'HTML %s' % get_math_stylesheet()}
+
+
+def get_themes():
+    """
+    result: { 'theme': theme_dict, ... }
+    """
+    return themeRegistry.themes()
+
+
+def get_theme_settings(theme, pygments):
+    """
+    pygments.css has been created in app.py so parameter pygments is unused.
+    """
+    return themeRegistry.settings(theme)
+
+
+class RenderContext(object):
+    """
+    Long-lived docutils state of one writer and settings combination.
+
+    It keeps the frozen settings and the content of the writer template and
+    embedded stylesheets keyed by path, mtime and size, so a render only
+    pays for parsing and writing.
+    """
+    def __init__(self, writer_name, overrides):
+        self.writer_name = writer_name
+        self.overrides = dict(overrides)
+        self.signature = repr(sorted(self.overrides.items()))
+        self._lock = threading.Lock()
+        self._files = {}
+        pub = Publisher(source_class=docutils_io.StringInput,
+                        destination_class=docutils_io.StringOutput)
+        pub.set_components('standalone', 'restructuredtext', writer_name)
+        pub.process_programmatic_settings(None, self.overrides, None)
+        self.settings = pub.settings
+        self.writer_class = type(pub.writer)
+        self.translator_class = getattr(pub.writer, 'translator_class', None)
+        if hasattr(self.writer_class, 'apply_template') and \
+                hasattr(self.translator_class, 'stylesheet_call'):
+            self.writer_class = cached_writer_class(self.writer_class, self)
+            self.translator_class = cached_translator_class(
+                self.translator_class, self)
+        if hasattr(self.translator_class, 'math_tags'):
+            self.translator_class = math_translator_class(
+                self.translator_class)
+        if hasattr(self.translator_class, 'starttag'):
+            self.translator_class = source_line_translator_class(
+                self.translator_class)
+
+    def readFile(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except (OSError, TypeError) as err:
+            logger.error(err)
+            return None
+
+    def cachedFile(self, path):
+        """ content of file, read again when the file is modified """
+        key = (path, dependency.stat_key(path))
+        with self._lock:
+            content = self._files.get(key)
+        if content is None:
+            content = self.readFile(path)
+            with self._lock:
+                # drop old content of path
+                for old_key in [k for k in self._files if k[0] == path]:
+                    del self._files[old_key]
+                self._files[key] = content
+        return content
+
+    def publisher(self, text, source_path=None):
+        """
+        publisher of one render with a copy of settings.
+        source_path: relative paths of directives and images are resolved
+                     against its directory instead of working directory
+        """
+        settings = copy.copy(self.settings)
+        settings.record_dependencies = utils.DependencyList()
+        writer = self.writer_class()
+        if self.translator_class:
+            writer.translator_class = self.translator_class
+        pub = Publisher(writer=writer,
+                        source_class=docutils_io.StringInput,
+                        destination_class=docutils_io.StringOutput,
+                        settings=settings)
+        pub.set_components('standalone', 'restructuredtext', self.writer_name)
+        pub.set_source(text, source_path)
+        # writer reads images relative to destination directory
+        if source_path:
+            pub.set_destination(
+                None, os.path.splitext(source_path)[0] + '.html')
+        else:
+            pub.set_destination(None, None)
+        return pub
+
+
+def cached_writer_class(writer_class, context):
+    class Writer(writer_class):
+        def apply_template(self):
+            template = context.cachedFile(self.document.settings.template)
+            if template is None:
+                return writer_class.apply_template(self)
+            return template % self.interpolation_dict()
+    return Writer
+
+
+def cached_translator_class(translator_class, context):
+    class Translator(translator_class):
+        def stylesheet_call(self, path, *args, **kwargs):
+            # math assets are linked, the page loads them only once
+            if self.settings.embed_stylesheet and \
+                    not is_math_asset(path):
+                content = context.cachedFile(path)
+                if content is not None:
+                    self.settings.record_dependencies.add(path)
+                    return self.embedded_stylesheet % content
+            elif os.path.isabs(path):
+                # preview has no destination path, link to absolute path
+                href = path.replace(os.sep, '/')
+                if not href.startswith('/'):
+                    href = '/' + href
+                return self.stylesheet_link % self.encode(href)
+            return translator_class.stylesheet_call(self, path, *args, **kwargs)
+    return Translator
+
+
+def math_translator_class(translator_class):
+    """
+    Converted math of html and mathml output is cached by latex source
+    and output mode.  Math which reports an error isn't cached.
+    """
+    class Translator(translator_class):
+        def visit_math(self, node):
+            if self.math_output not in ('html', 'mathml'):
+                return translator_class.visit_math(self, node)
+            is_block = isinstance(node, nodes.math_block)
+            key = hash_key(self.math_output, self.math_options, is_block,
+                           node.astext())
+            math_code = mathCache.get(key)
+            if math_code is None:
+                start = len(self.body)
+                messages = len(self.messages)
+                try:
+                    translator_class.visit_math(self, node)
+                finally:
+                    if len(self.messages) == messages:
+                        tag = self.math_tags[self.math_output][is_block]
+                        math_code = self.body[start + 1 if tag else start]
+                        mathCache.put(key, math_code)
+            # same output as visit_math of docutils
+            if self.math_output == 'html':
+                if self.math_options and not self.math_header:
+                    self.math_header = [
+                        self.stylesheet_call(utils.find_file_in_dirs(
+                            s, self.settings.stylesheet_dirs),
+                            adjust_path=True)
+                        for s in self.math_options.split(',')]
+            elif 'XHTML 1' in self.doctype:
+                self.content_type = self.content_type_mathml
+            tag = self.math_tags[self.math_output][is_block]
+            suffix = '\n' if is_block else ''
+            if tag:
+                self.body.append(self.starttag(
+                    node, tag, suffix=suffix,
+                    classes=self.math_tags[self.math_output][2]))
+            self.body.extend([math_code, suffix])
+            if tag:
+                self.body.append('</%s>%s' % (tag, suffix))
+            raise nodes.SkipChildren
+    return Translator
+
+
+def increasing_lines(lines):
+    """
+    keep the longest increasing subsequence of lines, others become 0.
+    Lines of some nodes, such as generated or moved ones, are out of order.
+    """
+    tails = []
+    tail_index = []
+    previous = [None] * len(lines)
+    for x, line in enumerate(lines):
+        i = bisect.bisect_left(tails, line)
+        if i == len(tails):
+            tails.append(line)
+            tail_index.append(x)
+        else:
+            tails[i] = line
+            tail_index[i] = x
+        previous[x] = tail_index[i - 1] if i else None
+    result = [0] * len(lines)
+    x = tail_index[-1] if tail_index else None
+    while x is not None:
+        result[x] = lines[x]
+        x = previous[x]
+    return result
+
+
+def source_line_translator_class(translator_class):
+    """
+    Block elements get a data-src attribute and their source lines are
+    written into a json script at the end of body, the n-th line belongs
+    to the n-th marked element.  Lines are kept out of the elements, so
+    inserting a line doesn't change the markup of following elements.
+    """
+    class Translator(translator_class):
+        def __init__(self, document):
+            translator_class.__init__(self, document)
+            self.source_lines = []
+            self._source_nodes = set()
+
+        def starttag(self, node, tagname, suffix='\n', empty=False, **attributes):
+            line = getattr(node, 'line', None)
+            if line and isinstance(node, (nodes.Body, nodes.title)) and \
+                    not isinstance(node, nodes.Inline) and \
+                    id(node) not in self._source_nodes:
+                self._source_nodes.add(id(node))
+                self.source_lines.append(line)
+                attributes['data-src'] = ''
+            return translator_class.starttag(
+                self, node, tagname, suffix, empty, **attributes)
+
+        def depart_document(self, node):
+            self.body.append(
+                '<script type="application/json" id="rsteditor-lines">'
+                '%s</script>\n' % json.dumps(increasing_lines(self.source_lines)))
+            translator_class.depart_document(self, node)
+    return Translator
+
+
+# written by source_line_translator_class for the preview only
+SOURCE_ATTRIBUTE = re.compile(br' data-src=""(?=[^<>]*>)')
+SOURCE_LINES = re.compile(
+    br'<script type="application/json" id="rsteditor-lines">[^<]*</script>\n')
+
+
+def strip_source_lines(html):
+    """ html of preview as docutils writes it, without the line map """
+    if isinstance(html, str):
+        return strip_source_lines(html.encode('utf-8')).decode('utf-8')
+    return SOURCE_ATTRIBUTE.sub(b'', SOURCE_LINES.sub(b'', html))
+
+
+renderContexts = OrderedDict()
+renderContextsLock = threading.Lock()
+render_contexts_size = 8
+
+
+def get_render_context(writer_name, overrides):
+    key = hash_key(writer_name, sorted(overrides.items()),
+                   themeRegistry.version)
+    with renderContextsLock:
+        context = renderContexts.get(key)
+        if context:
+            renderContexts.move_to_end(key)
+            return context
+    context = RenderContext(writer_name, overrides)
+    with renderContextsLock:
+        renderContexts[key] = context
+        while len(renderContexts) > render_contexts_size:
+            renderContexts.popitem(last=False)
+    return context
+
+
+def htmlcode_key(rst_text, theme='docutils', pygments='docutils', settings={},
+                 focus=None, source_path=None):
+    """ cache key of rst2htmlcode result """
+    themeRegistry.update()
+    return hash_key(rst_text, theme, pygments, themeRegistry.version,
+                    sorted(settings.items()), focus, source_path,
+                    docutils.__version__)
+
+
+def rst2htmlcode(rst_text, theme='docutils', pygments='docutils', settings={},
+                 timings=None, focus=None, dependencies=None,
+                 source_path=None):
+    """
+    focus: source line, only sections around it are written
+    dependencies: list, [(path, stat), ...] of included files is added
+    source_path: absolute path of document, base of relative paths
+    """
     output = None
     try:
         overrides = {}
         overrides.update(default_overrides)
-        overrides.update(settings)
         overrides.update(get_theme_settings(theme, pygments))
+        # such as draft_overrides
+        overrides.update(settings)
         logger.debug(overrides)
-        output = publish_string(
-            rst_text,
-            writer_name='html5',
-            settings_overrides=overrides,
-        )
+        context = get_render_context('html5', overrides)
+        output = previewRenderer.render(rst_text, context, timings, focus,
+                                        dependencies, source_path)
     except Exception as err:
         logger.error(err)
         output = str(err)
     return output
 
 
+def publish_file(writer_name, rst_file, filename, theme='docutils',
+                 pygments='docutils', settings={}, progress=None):
+    """
+    publish rst_file to filename step by step, raise exception on error.
+    writer_name: html5 or odt
+    progress: callable(percent, stage)
+    """
+    overrides = {}
+    overrides.update(default_overrides)
+    overrides.update(settings)
+    overrides.update(get_theme_settings(theme, pygments))
+    logger.debug(overrides)
+    if writer_name == 'odt':
+        reader = Reader()
+        writer = Writer()
+        destination_class = docutils_io.BinaryFileOutput
+    else:
+        reader = writer = None
+        destination_class = docutils_io.FileOutput
+    pub = Publisher(reader=reader, writer=writer,
+                    source_class=docutils_io.FileInput,
+                    destination_class=destination_class)
+    pub.set_components('standalone', 'restructuredtext', writer_name)
+    pub.process_programmatic_settings(None, overrides, None)
+    pub.set_source(None, rst_file)
+    pub.set_destination(None, filename)
+    if progress:
+        progress(10, 'read')
+    pub.document = pub.reader.read(pub.source, pub.parser, pub.settings)
+    if progress:
+        progress(40, 'transform')
+    pub.apply_transforms()
+    if progress:
+        progress(60, 'write')
+    output = pub.writer.write(pub.document, pub.destination)
+    pub.writer.assemble_parts()
+    if progress:
+        progress(100, 'done')
+    return output
+
+
 def rst2html(rst_file, filename, theme='docutils', pygments='docutils', settings={}):
     output = None
     try:
-        overrides = {}
-        overrides.update(default_overrides)
-        overrides.update(settings)
-        overrides.update(get_theme_settings(theme, pygments))
-        logger.debug(overrides)
-        output = publish_cmdline(
-            writer_name='html5',
-            settings_overrides=overrides,
-            argv=[
-                rst_file,
-                filename,
-            ]
-        )
+        output = publish_file('html5', rst_file, filename, theme, pygments,
+                              settings)
     except Exception as err:
         logger.error(err)
         output = err
@@ -147,22 +585,8 @@ def rst2html(rst_file, filename, theme='docutils', pygments='docutils', settings
 def rst2odt(rst_file, filename, theme='docutils', pygments='docutils', settings={}):
     output = None
     try:
-        overrides = {}
-        overrides.update(default_overrides)
-        overrides.update(settings)
-        overrides.update(get_theme_settings(theme, pygments))
-        logger.debug(overrides)
-        writer = Writer()
-        reader = Reader()
-        output = publish_cmdline_to_binary(
-            reader=reader,
-            writer=writer,
-            settings_overrides=overrides,
-            argv=[
-                rst_file,
-                filename,
-            ]
-        )
+        output = publish_file('odt', rst_file, filename, theme, pygments,
+                              settings)
     except Exception as err:
         logger.error(err)
         output = err
@@ -0,0 +1,137 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PreviewJob(object):
+    """ one preview request, a snapshot of editor text """
+    def __init__(self, generation, text, path, **options):
+        self.generation = generation
+        self.text = text
+        self.path = path
+        self.options = options
+        self.html = ''
+        # seconds of preview stages
+        self.timings = {}
+        # [(path, stat), ...] of files included by text
+        self.dependencies = []
+
+
+class PreviewScheduler(object):
+    """
+    Latest-wins preview queue.
+
+    Every request gets a new generation number and replaces the pending
+    one, so the worker always renders the newest snapshot.  The worker
+    waits ``delay`` seconds after the last request before rendering,
+    the delay follows the average time of recent renders.
+
+    Typing is previewed with a draft render when full renders take
+    longer than ``draft_budget`` seconds.
+    """
+    min_delay = 0.05
+    max_delay = 1.0
+    # weight of the newest render time in the moving average
+    smoothing = 0.3
+    # 0 disables draft render
+    draft_budget = 0.5
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._generation = 0
+        self._pending = None
+        self._pending_time = 0
+        self._urgent = False
+        self._quit = False
+        self._render_time = 0.0
+        self._full_time = 0.0
+        self.stats = {
+            'requested': 0,
+            'rendered': 0,
+            'draft': 0,
+            'superseded': 0,
+            'discarded': 0,
+        }
+
+    def request(self, text, path, urgent=False, **options):
+        """
+        queue a preview request and return its generation
+        urgent: render without debounce, such as open file or Ctrl+P
+        """
+        with self._cond:
+            self._generation += 1
+            if self._pending:
+                self.stats['superseded'] += 1
+            self._pending = PreviewJob(self._generation, text, path, **options)
+            self._pending_time = time.monotonic()
+            self._urgent = self._urgent or urgent
+            self.stats['requested'] += 1
+            self._cond.notify()
+            return self._generation
+
+    def take(self):
+        """
+        block until a request is ready, return None when quit
+        """
+        with self._cond:
+            while True:
+                if self._quit:
+                    return None
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                if not self._urgent:
+                    remain = self._pending_time + self.delay() - time.monotonic()
+                    if remain > 0:
+                        # a newer request restarts the debounce
+                        self._cond.wait(remain)
+                        continue
+                job = self._pending
+                self._pending = None
+                self._urgent = False
+                return job
+
+    def done(self, job, elapsed):
+        """
+        record render time, return False if the result is out of date
+        """
+        with self._cond:
+            if self._render_time:
+                self._render_time += self.smoothing * (elapsed - self._render_time)
+            else:
+                self._render_time = elapsed
+            if job.options.get('draft'):
+                self.stats['draft'] += 1
+            elif self._full_time:
+                self._full_time += self.smoothing * (elapsed - self._full_time)
+            else:
+                self._full_time = elapsed
+            self.stats['rendered'] += 1
+            if job.generation != self._generation:
+                self.stats['discarded'] += 1
+                logger.debug('Preview %s is out of date', job.generation)
+                return False
+            return True
+
+    def useDraft(self):
+        """ full render is over budget """
+        with self._cond:
+            return bool(self.draft_budget) and self._full_time > self.draft_budget
+
+    def isCurrent(self, generation):
+        with self._cond:
+            return generation == self._generation
+
+    def discard(self, job):
+        with self._cond:
+            self.stats['discarded'] += 1
+
+    def delay(self):
+        return min(self.max_delay, max(self.min_delay, self._render_time))
+
+    def quit(self):
+        with self._cond:
+            self._quit = True
+            self._cond.notify_all()
@@ -1,12 +1,302 @@
 import re
 import logging
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import compress
 
 from PyQt5 import Qsci, QtGui, QtCore
 
 from ..util import toUtf8
 
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:     # python < 3.11
+    import sre_parse
+    import sre_constants
+
 logger = logging.getLogger(__name__)
 
+# 1 for first byte of UTF-8 character, 0 for continuation bytes
+_UTF8_LEADS = bytes(0 if 0x80 <= b < 0xc0 else 1 for b in range(256))
+_LINE_END = re.compile(r'\r\n|\r|\n')
+_REPEATS = tuple(getattr(sre_constants, name) for name in (
+    'MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+    if hasattr(sre_constants, name))
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: re.compile(r'\d'),
+    sre_constants.CATEGORY_NOT_DIGIT: re.compile(r'\D'),
+    sre_constants.CATEGORY_SPACE: re.compile(r'\s'),
+    sre_constants.CATEGORY_NOT_SPACE: re.compile(r'\S'),
+    sre_constants.CATEGORY_WORD: re.compile(r'\w'),
+    sre_constants.CATEGORY_NOT_WORD: re.compile(r'\W'),
+}
+
+
+def _first_set(items):
+    """
+    items which may match the first character of pattern items.
+    result: (items or None for any character, pattern may be empty)
+    """
+    first = []
+    for op, av in items:
+        if op is sre_constants.AT:
+            continue
+        elif op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL,
+                    sre_constants.IN):
+            first.append((op, av))
+            return first, False
+        elif op is sre_constants.SUBPATTERN:
+            sub, nullable = _first_set(av[-1])
+            if sub is None:
+                return None, False
+            first.extend(sub)
+            if not nullable:
+                return first, False
+        elif op in _REPEATS:
+            sub, nullable = _first_set(av[2])
+            if sub is None:
+                return None, False
+            first.extend(sub)
+            if av[0] > 0 and not nullable:
+                return first, False
+        elif op is sre_constants.BRANCH:
+            nullable = False
+            for branch in av[1]:
+                sub, empty = _first_set(branch)
+                if sub is None:
+                    return None, False
+                first.extend(sub)
+                nullable = nullable or empty
+            if not nullable:
+                return first, False
+        else:
+            # ANY, backreference, lookaround...
+            return None, False
+    return first, True
+
+
+def _in_set(items, char):
+    """ True, False or None if not known """
+    negate = False
+    found = False
+    for op, av in items:
+        if op is sre_constants.NEGATE:
+            negate = True
+        elif op is sre_constants.LITERAL:
+            found = found or chr(av) == char
+        elif op is sre_constants.RANGE:
+            found = found or av[0] <= ord(char) <= av[1]
+        elif op is sre_constants.CATEGORY and av in _CATEGORIES:
+            found = found or bool(_CATEGORIES[av].match(char))
+        else:
+            return None
+    return found != negate
+
+
+def _may_start(first, char, flags):
+    """ may char start a pattern of first set, never False by mistake """
+    if first is None:
+        return True
+    chars = {char}
+    if flags & re.IGNORECASE:
+        chars.update((char.lower(), char.upper()))
+    for op, av in first:
+        for c in chars:
+            if op is sre_constants.LITERAL:
+                if chr(av) == c:
+                    return True
+            elif op is sre_constants.NOT_LITERAL:
+                if chr(av) != c:
+                    return True
+            elif _in_set(av, c) is not False:
+                return True
+    return False
+
+
+def _shift_groups(regex, shift):
+    r""" renumber backreferences \1 to \99 of regex by shift """
+    def repl(mo):
+        number = mo.group(1)
+        if number == '\\' or number.startswith('0'):
+            return mo.group(0)
+        return '\\%d' % (int(number) + shift)
+    return re.sub(r'\\(\\|\d{1,2})', repl, regex)
+
+
+class RegexTokenizer(object):
+    """
+    Match the first of ordered (key, regex) tokens in one regex call.
+
+    Tokens are joined into an alternation of named groups, which matches
+    as trying them in order.  Tokens which can't start with the character
+    at the position are left out, the alternation of each set of tokens
+    is compiled once.
+    """
+    def __init__(self, tokens, flags=0):
+        self.flags = flags
+        self.tokens = []
+        self._groups = {}
+        self._first = {}
+        for key, regex in tokens:
+            self.tokens.append((key, regex))
+            self._groups[key] = re.compile(regex, flags).groups
+            try:
+                self._first[key] = _first_set(
+                    sre_parse.parse(regex, flags))[0]
+            except Exception as err:
+                logger.debug('no first set of %s: %s', key, err)
+                self._first[key] = None
+        self._keys = tuple(key for key, regex in self.tokens)
+        # char -> alternation, empty string is used at end of text
+        self._dispatch = {}
+        self._alternations = {}
+
+    def _alternation(self, keys):
+        alternation = self._alternations.get(keys)
+        if alternation is None:
+            regex = dict(self.tokens)
+            parts = []
+            groups = 0
+            for key in keys:
+                parts.append('(?P<%s>%s)' % (
+                    key, _shift_groups(regex[key], groups + 1)))
+                groups += 1 + self._groups[key]
+            alternation = re.compile('|'.join(parts) or '(?!)', self.flags)
+            self._alternations[keys] = alternation
+        return alternation
+
+    def _lookup(self, char):
+        if char:
+            keys = tuple(key for key in self._keys
+                         if _may_start(self._first[key], char, self.flags))
+        else:
+            keys = self._keys
+        alternation = self._dispatch[char] = self._alternation(keys)
+        return alternation
+
+    def match(self, text, pos=0):
+        """ return match object of first matched token, key is lastgroup """
+        char = text[pos:pos + 1]
+        alternation = self._dispatch.get(char)
+        if alternation is None:
+            alternation = self._lookup(char)
+        return alternation.match(text, pos)
+
+
+class StyledSpans(object):
+    """
+    Block token spans of the document, sorted by start position.
+
+    Starts and lengths are kept in parallel arrays for bisect lookup and
+    slice deletion, spans are shifted as text is inserted or deleted.
+    """
+    def __init__(self):
+        self.starts = array('q')
+        self.lengths = array('q')
+        self.keys = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def clear(self):
+        del self.starts[:]
+        del self.lengths[:]
+        del self.keys[:]
+
+    def bisect(self, pos):
+        """ index of first span starting after pos """
+        return bisect_right(self.starts, pos)
+
+    def keyAt(self, pos):
+        """ key of span starting at pos or None """
+        i = bisect_left(self.starts, pos)
+        if i < len(self.starts) and self.starts[i] == pos:
+            return self.keys[i]
+        return None
+
+    def replace(self, start, end, spans):
+        """ replace spans starting in [start, end) with sorted spans """
+        i = bisect_left(self.starts, start)
+        j = bisect_left(self.starts, end, i)
+        self.starts[i:j] = array('q', [span[0] for span in spans])
+        self.lengths[i:j] = array('q', [span[1] for span in spans])
+        self.keys[i:j] = [span[2] for span in spans]
+
+    def _shiftFrom(self, i, delta):
+        if i < len(self.starts):
+            self.starts[i:] = array('q', [s + delta for s in self.starts[i:]])
+
+    def insertText(self, pos, length):
+        i = bisect_left(self.starts, pos)
+        if i > 0 and self.starts[i - 1] + self.lengths[i - 1] > pos:
+            self.lengths[i - 1] += length
+        self._shiftFrom(i, length)
+
+    def deleteText(self, pos, length):
+        end = pos + length
+        i = bisect_left(self.starts, pos)
+        if i > 0 and self.starts[i - 1] + self.lengths[i - 1] > pos:
+            span_end = self.starts[i - 1] + self.lengths[i - 1]
+            self.lengths[i - 1] -= min(span_end, end) - pos
+        j = bisect_left(self.starts, end, i)
+        if j > i:
+            span_end = self.starts[j - 1] + self.lengths[j - 1]
+            if span_end > end:
+                # keep rest of span which begins in deleted text
+                self.starts[j - 1] = end
+                self.lengths[j - 1] = span_end - end
+                j -= 1
+            del self.starts[i:j]
+            del self.lengths[i:j]
+            del self.keys[i:j]
+        self._shiftFrom(i, -length)
+
+
+class TextRange(object):
+    """
+    Text of whole lines [first_line, last_line) of editor, fetched with
+    one SCI_GETTEXTRANGE call and shared by block and inline styling.
+
+    Character offsets of text are mapped to scintilla positions with a
+    table of the UTF-8 lead bytes, built once per range.
+    """
+    def __init__(self, editor=None, first_line=0, last_line=0):
+        self.first_line = first_line
+        self.start = 0
+        self.data = b''
+        if editor:
+            self.start = editor.positionFromLineIndex(first_line, 0)
+        if editor and last_line > first_line:
+            end = editor.positionFromLineIndex(last_line, 0)
+            # with terminating NUL
+            self.data = bytes(editor.bytes(self.start, end))[:-1]
+        self.text = toUtf8(self.data)
+        # byte offset of every character and of the end, None for ascii
+        self._offsets = None
+        if len(self.data) != len(self.text):
+            leads = self.data.translate(_UTF8_LEADS) + b'\x01'
+            self._offsets = array('q', compress(range(len(leads)), leads))
+        self._line_starts = None
+
+    def position(self, offset):
+        """ scintilla position of character offset of text """
+        if self._offsets is None:
+            return self.start + offset
+        return self.start + self._offsets[offset]
+
+    def lineOffset(self, line):
+        """ character offset of line start """
+        if self._line_starts is None:
+            # same line ends as scintilla: \r\n, \r and \n
+            self._line_starts = [0]
+            self._line_starts.extend(
+                mo.end() for mo in _LINE_END.finditer(self.text))
+        return self._line_starts[line - self.first_line]
+
+    def line(self, line):
+        """ text of line with end of line """
+        return self.text[self.lineOffset(line):self.lineOffset(line + 1)]
+
 
 class QsciLexerRest(Qsci.QsciLexerCustom):
     keyword_list = [
@@ -162,7 +452,10 @@ class QsciLexerRest(Qsci.QsciLexerCustom):
         ('in_unusedspace', r'''( +)\n'''),
     ]
     styled_text = None
+    # end of text modified since last styling
+    modified_end = None
     block_tokens = None
+    block_tokenizer = None
     inline_tokens = None
 
     def __init__(self, *args, **kwargs):
@@ -172,9 +465,10 @@ class QsciLexerRest(Qsci.QsciLexerCustom):
         self.setDefaultFont(QtGui.QFont('Monospace', 12))
         self.rstyles = dict(zip(*(self.styles.values(), self.styles.keys())))
         # to store global styleing
-        self.styled_text = {}
+        self.styled_text = StyledSpans()
         self.block_tokens = []
         self.inline_tokens = []
+        block_regex = []
         for key, regex in self.token_regex:
             if key.startswith('in_'):
                 self.inline_tokens.append((key, re.compile(
@@ -186,6 +480,11 @@ class QsciLexerRest(Qsci.QsciLexerCustom):
                     regex,
                     re.UNICODE | re.MULTILINE | re.IGNORECASE,
                 )))
+                block_regex.append((key, regex))
+        self.block_tokenizer = RegexTokenizer(
+            block_regex,
+            re.UNICODE | re.MULTILINE | re.IGNORECASE,
+        )
         return
 
     def language(self):
@@ -196,117 +495,130 @@ class QsciLexerRest(Qsci.QsciLexerCustom):
 
     def clear(self):
         self.styled_text.clear()
+        self.modified_end = None
 
     def getStyleAt(self, pos):
         return self.editor().SendScintilla(Qsci.QsciScintilla.SCI_GETSTYLEAT, pos)
 
     def getTextRange(self, start, end):
+        """ TextRange of lines from start to line of end """
         if not self.editor():
-            return ''
+            return TextRange()
         bs_line, _ = self.editor().lineIndexFromPosition(start)
         be_line, _ = self.editor().lineIndexFromPosition(end)
-        text = []
-        for x in range(bs_line, be_line):
-            text.append(self.editor().text(x))
-        return toUtf8(''.join(text))
+        return TextRange(self.editor(), bs_line, be_line)
+
+    def setEditor(self, editor):
+        if self.editor():
+            self.editor().SCN_MODIFIED.disconnect(self.onModified)
+        super(QsciLexerRest, self).setEditor(editor)
+        self.clear()
+        if editor:
+            editor.SCN_MODIFIED.connect(self.onModified)
+
+    def onModified(self, position, mtype, text, length, *args):
+        """ keep styled positions at their text """
+        end = self.modified_end
+        if mtype & Qsci.QsciScintilla.SC_MOD_INSERTTEXT:
+            self.styled_text.insertText(position, length)
+            if end is not None and end > position:
+                end += length
+            self.modified_end = max(end or 0, position + length)
+        elif mtype & Qsci.QsciScintilla.SC_MOD_DELETETEXT:
+            self.styled_text.deleteText(position, length)
+            if end is not None and end >= position + length:
+                self.modified_end = end - length
+            else:
+                self.modified_end = position
 
     def getStylingPosition(self, start, end):
         """
         inline style and global style is confilicted at calling.
         Need a list to store global style position
         """
-        styled_keys = sorted(self.styled_text.keys())
-        if not styled_keys:
+        spans = self.styled_text
+        if not spans:
             return (start, end)
-        new_start = 0
-        new_end = self.editor().length()
-        for x in range(len(styled_keys)):
-            pos = styled_keys[x]
-            if start < pos:
-                x = max(x - 2, 0)
-                while x >= 0:
-                    new_start = styled_keys[x]
-                    style_key = self.styled_text[new_start]['style']
-                    # find first non-string style
-                    if self.styles[style_key] != self.styles['string']:
-                        break
-                    x -= 1
-                break
-        for y in range(len(styled_keys)):
-            pos = styled_keys[y]
-            if end < pos:
-                y = min(y + 2, len(styled_keys) - 1)
-                while y < len(styled_keys):
-                    new_end = styled_keys[y]
-                    style_key = self.styled_text[new_end]['style']
-                    # find last non-string style
-                    if self.styles[style_key] != self.styles['string']:
-                        break
-                    y += 1
-                break
-        for k in styled_keys[x:y]:
-            del self.styled_text[k]
+        string = self.styles['string']
+        x = spans.bisect(start)
+        if x > 0:
+            x = max(x - 2, 0)
+            # find first non-string style
+            while x > 0 and self.styles[spans.keys[x]] == string:
+                x -= 1
+            new_start = spans.starts[x]
+        else:
+            new_start = 0
+        y = spans.bisect(end)
+        if y < len(spans):
+            y = min(y + 2, len(spans) - 1)
+            # find last non-string style
+            while y < len(spans) - 1 and self.styles[spans.keys[y]] == string:
+                y += 1
+            new_end = spans.starts[y]
+        else:
+            new_end = self.editor().length()
         return (new_start, new_end)
 
-    def do_StylingText(self, start, end):
+    def do_StylingText(self, start, end, text_range=None):
         """
-        To support non-latin character, function 'positionFromLineIndex'
-        will be called for difference length between latin and non-latin.
+        Text is styled from the beginning of line of start, character
+        offsets are mapped to positions by TextRange to support non-latin
+        character.
+
+        Styling stops at a line after the modified text where the token
+        is the same as stored, the rest is styled already.  Return the
+        position where styling stopped.
         """
-        text = self.getTextRange(start, end)
+        if text_range is None:
+            text_range = self.getTextRange(start, end)
+        text = text_range.text
         logger.debug('styling text: %s', repr(text))
-        line, index = self.editor().lineIndexFromPosition(start)
-        m_start = start
+        start = m_start = text_range.start
         offset = 0
+        spans = []
         self.startStyling(start)
         while offset < len(text):
-            mo = None
-            for key, tok in self.block_tokens:
-                mo = tok.match(text, offset)
-                if mo:
-                    break
+            mo = self.block_tokenizer.match(text, offset)
             assert mo, repr(text[offset:])
-            m_string = text[offset:mo.end()]
-            line_fix = m_string.count('\n')
-            end_line = line + line_fix
-            if line_fix > 0:    # calculate length in last line
-                end_index = 0
-            else:
-                end_index = index + len(m_string)
-            m_end = self.editor().positionFromLineIndex(end_line, end_index)
-            message = '%s(%s,%s): %s' % (key, m_start, m_end, repr(m_string))
+            key = mo.lastgroup
+            if (offset == 0 or text[offset - 1] == '\n') and \
+                    self.modified_end is not None and \
+                    m_start > self.modified_end and \
+                    self.styled_text.keyAt(m_start) == key:
+                logger.debug('converged at %s(%s)', m_start, key)
+                self.styled_text.replace(start, m_start, spans)
+                return m_start
+            m_end = text_range.position(mo.end())
+            message = '%s(%s,%s): %s' % (
+                key, m_start, m_end, repr(text[offset:mo.end()]))
             logger.debug(message)
             if (m_end - m_start) > 0:
                 self.setStyling(m_end - m_start, self.styles[key])
-                self.styled_text[m_start] = {
-                    'length': m_end - m_start,
-                    'style': key,
-                }
+                spans.append((m_start, m_end - m_start, key))
             else:
                 logger.error('*** !!! length < 0 !!! ***')
-                logger.debug('Error: match %s from %s(%s,%s) to %s(%s,%s)' % (
-                    repr(m_string),
-                    m_start, line, index,
-                    m_end, end_line, end_index,
-                ))
             # next position
             m_start = m_end
-            line = end_line
-            index = end_index
             offset = mo.end()
+        self.styled_text.replace(start, end, spans)
+        return end
 
-    def do_InlineStylingText(self, start, end):
+    def do_InlineStylingText(self, start, end, text_range=None):
         bs_line, index = self.editor().lineIndexFromPosition(start)
         be_line, index = self.editor().lineIndexFromPosition(end)
+        if text_range is None:
+            text_range = self.getTextRange(start, end)
         for line in range(bs_line, be_line):
-            line_text = toUtf8(self.editor().text(line))
+            line_text = text_range.line(line)
+            line_offset = text_range.lineOffset(line)
             for key, tok in self.inline_tokens:
                 mo_list = tok.finditer(line_text)
                 for mo in mo_list:
                     l_start = mo.start(1)
                     l_end = mo.end(1)
-                    m_start = self.editor().positionFromLineIndex(line, l_start)
-                    m_end = self.editor().positionFromLineIndex(line, l_end)
+                    m_start = text_range.position(line_offset + l_start)
+                    m_end = text_range.position(line_offset + l_end)
                     assert(m_end - m_start)
                     message = '%s(%s,%s): %s' % (key, line + 1, l_start, repr(line_text[l_start:l_end]))
                     logger.debug(message)
@@ -324,8 +636,11 @@ class QsciLexerRest(Qsci.QsciLexerCustom):
         s_start, s_end = self.getStylingPosition(start, end)
         logger.debug('** Fix styled range from (%s,%s) to (%s,%s) **' % (
             start, end, s_start, s_end))
-        self.do_StylingText(s_start, s_end)
-        self.do_InlineStylingText(s_start, s_end)
+        text_range = self.getTextRange(s_start, s_end)
+        s_end = self.do_StylingText(s_start, s_end, text_range)
+        self.do_InlineStylingText(s_start, s_end, text_range)
+        if self.modified_end is not None and s_end >= self.modified_end:
+            self.modified_end = None
         # tell to end styling
         self.startStyling(self.editor().length())
         logger.debug('%s %s %s' % ('=' * 35, 'style end', '=' * 35))
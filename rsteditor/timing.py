@@ -0,0 +1,91 @@
+import time
+import json
+import logging
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# stages of one preview pass in display order
+STAGES = ['parse', 'transform', 'write', 'render', 'display', 'codeview']
+
+
+@contextmanager
+def measure(timings, stage):
+    """ add elapsed seconds of block to timings[stage] """
+    if timings is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.monotonic() - start
+
+
+def percentile(values, percent):
+    """ nearest-rank percentile of sorted values """
+    if not values:
+        return 0.0
+    index = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class RenderStats(object):
+    """
+    Rolling histogram of the latest ``size`` timings of every stage.
+    Timings are appended to a json lines file if ``log_path`` is set.
+    """
+    def __init__(self, size=200, log_path=None):
+        self.size = size
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._samples = OrderedDict()
+
+    def record(self, timings, **info):
+        with self._lock:
+            for stage, value in timings.items():
+                if stage not in self._samples:
+                    self._samples[stage] = deque(maxlen=self.size)
+                self._samples[stage].append(value)
+        if self.log_path:
+            record = {'time': time.time()}
+            record.update(info)
+            record['stages'] = timings
+            try:
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            except OSError as err:
+                logger.error(err)
+                self.log_path = None
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+    def summary(self):
+        """
+        result: { stage: (count, p50, p95, p99), ... } in seconds
+        """
+        result = OrderedDict()
+        with self._lock:
+            stages = [s for s in STAGES if s in self._samples]
+            stages += [s for s in self._samples if s not in STAGES]
+            for stage in stages:
+                values = sorted(self._samples[stage])
+                result[stage] = (
+                    len(values),
+                    percentile(values, 50),
+                    percentile(values, 95),
+                    percentile(values, 99),
+                )
+        return result
+
+    def report(self):
+        """ text table of summary in milliseconds """
+        lines = ['%-10s %6s %9s %9s %9s' % ('stage', 'count', 'p50', 'p95', 'p99')]
+        for stage, (count, p50, p95, p99) in self.summary().items():
+            lines.append('%-10s %6d %9.1f %9.1f %9.1f' % (
+                stage, count, p50 * 1000, p95 * 1000, p99 * 1000))
+        return '\n'.join(lines)
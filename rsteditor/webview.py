@@ -1,17 +1,383 @@
 
+import os
+import json
+import logging
+import mimetypes
+
 from PyQt5 import QtGui, QtCore, QtWidgets, QtWebEngineWidgets
 
+try:
+    from PyQt5 import QtWebEngineCore
+except ImportError:
+    QtWebEngineCore = None
+
 from rsteditor import util
+from rsteditor import htmldiff
+from rsteditor.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# preview page, images and stylesheets are served by PreviewSchemeHandler
+SCHEME = b'rsteditor'
+# QWebEngineView.setHtml fails with larger content
+SETHTML_LIMIT = 2 * 1024 * 1024
+
+PATCH_JS = '''
+(function(path, start, count, html) {
+    var virtual = window.rsteditorVirtual;
+    var parent = document.body;
+    for (var i = 0; i < path.length; i++) {
+        parent = parent.children[path[i]];
+        if (virtual && parent.rsteditorElement) {
+            parent = virtual.restore(parent);
+        }
+    }
+    if (window.rsteditorSync) {
+        window.rsteditorSync.reset();
+    }
+    for (var i = 0; i < count; i++) {
+        parent.removeChild(parent.children[start]);
+    }
+    if (start < parent.children.length) {
+        parent.children[start].insertAdjacentHTML('beforebegin', html);
+    } else {
+        parent.insertAdjacentHTML('beforeend', html);
+    }
+    if (virtual) {
+        virtual.refresh();
+    }
+    return parent.children.length;
+})(%s, %s, %s, %s);
+'''
+
+# line map is not part of patches, see htmldiff.split_line_map
+LINES_JS = '''
+(function(lines) {
+    var data = document.getElementById('rsteditor-lines');
+    if (data) {
+        data.textContent = lines;
+    }
+    if (window.rsteditorSync) {
+        window.rsteditorSync.reset();
+    }
+})(%s);
+'''
+
+# source line to page offset map, elements with data-src attribute and
+# their lines in #rsteditor-lines are written by output.rst2htmlcode
+SYNC_JS = '''
+window.rsteditorSync = {
+    lines: null,
+    offsets: null,
+    reset: function() {
+        this.lines = null;
+        this.offsets = null;
+    },
+    build: function() {
+        var data = document.getElementById('rsteditor-lines');
+        var lines = data ? JSON.parse(data.textContent) : [];
+        // anchors in detached sections are kept by their placeholders
+        var elements = document.querySelectorAll('[data-src], .rsteditor-placeholder');
+        var tops = [];
+        for (var i = 0; i < elements.length; i++) {
+            var top = elements[i].getBoundingClientRect().top + window.scrollY;
+            var anchors = elements[i].rsteditorAnchors;
+            if (anchors) {
+                for (var j = 0; j < anchors.length; j++) {
+                    tops.push(top + anchors[j]);
+                }
+            } else {
+                tops.push(top);
+            }
+        }
+        var count = Math.min(lines.length, tops.length);
+        this.lines = [0];
+        this.offsets = [0];
+        for (var i = 0; i < count; i++) {
+            if (!lines[i]) {
+                continue;
+            }
+            if (tops[i] >= this.offsets[this.offsets.length - 1]) {
+                this.lines.push(lines[i]);
+                this.offsets.push(tops[i]);
+            }
+        }
+    },
+    search: function(values, value) {
+        // last index of values[index] <= value
+        var low = 0, high = values.length - 1;
+        while (low < high) {
+            var middle = (low + high + 1) >> 1;
+            if (values[middle] <= value) {
+                low = middle;
+            } else {
+                high = middle - 1;
+            }
+        }
+        return low;
+    },
+    interpolate: function(from, to, value) {
+        var i = this.search(from, value);
+        if (i + 1 >= from.length || from[i + 1] == from[i]) {
+            return to[i];
+        }
+        return to[i] + (to[i + 1] - to[i]) * (value - from[i]) / (from[i + 1] - from[i]);
+    },
+    scrollToLine: function(line, ratio) {
+        if (!this.lines) {
+            this.build();
+        }
+        if (this.lines.length < 2) {
+            window.scrollTo(0, document.body.scrollHeight * ratio);
+            return;
+        }
+        window.scrollTo(0, this.interpolate(this.lines, this.offsets, line));
+    },
+    lineAt: function(offset) {
+        if (!this.lines) {
+            this.build();
+        }
+        if (this.lines.length < 2) {
+            return -1;
+        }
+        return this.interpolate(this.offsets, this.lines, offset);
+    },
+};
+window.addEventListener('resize', function() {
+    if (window.rsteditorVirtual) {
+        // heights of placeholders are out of date
+        window.rsteditorVirtual.restoreAll();
+    }
+    window.rsteditorSync.reset();
+});
+// images change offsets after they are loaded
+window.addEventListener('load', function() { window.rsteditorSync.reset(); }, true);
+'''
+
+
+# Huge pages keep only sections near viewport in DOM. Others are
+# replaced by placeholders of the same height and attached again by
+# IntersectionObserver when they come near viewport.
+VIRTUAL_JS = '''
+window.rsteditorVirtual = {
+    // virtualize pages with more elements
+    minElements: 10000,
+    enabled: false,
+    // no detach until next refresh
+    paused: false,
+    observer: null,
+    container: null,
+    findContainer: function() {
+        var container = document.querySelector('main') || document.body;
+        while (true) {
+            var sections = container.querySelectorAll(':scope > section');
+            if (sections.length != 1) {
+                return container;
+            }
+            container = sections[0];
+        }
+    },
+    refresh: function() {
+        if (!this.enabled) {
+            if (document.getElementsByTagName('*').length < this.minElements) {
+                return;
+            }
+            var self = this;
+            this.enabled = true;
+            this.observer = new IntersectionObserver(function(entries) {
+                self.onIntersection(entries);
+            }, {rootMargin: '100% 0px'});
+        }
+        var container = this.findContainer();
+        if (container !== this.container) {
+            this.restoreAll();
+            this.container = container;
+        }
+        this.paused = false;
+        var children = container.children;
+        for (var i = 0; i < children.length; i++) {
+            if (children[i].tagName != 'SCRIPT' && children[i].tagName != 'STYLE') {
+                // observe again for a fresh intersection callback
+                this.observer.unobserve(children[i]);
+                this.observer.observe(children[i]);
+            }
+        }
+    },
+    onIntersection: function(entries) {
+        var detached = [];
+        for (var i = 0; i < entries.length; i++) {
+            var node = entries[i].target;
+            if (node.parentNode !== this.container) {
+                // removed by patch
+                this.observer.unobserve(node);
+            } else if (entries[i].isIntersecting) {
+                if (node.rsteditorElement) {
+                    this.restore(node);
+                }
+            } else if (!node.rsteditorElement && !this.paused) {
+                detached.push(node);
+            }
+        }
+        // measure all before changing DOM
+        var placeholders = [];
+        for (var i = 0; i < detached.length; i++) {
+            placeholders.push(this.placeholder(detached[i]));
+        }
+        for (var i = 0; i < detached.length; i++) {
+            this.observer.unobserve(detached[i]);
+            detached[i].replaceWith(placeholders[i]);
+            this.observer.observe(placeholders[i]);
+        }
+    },
+    placeholder: function(element) {
+        var rect = element.getBoundingClientRect();
+        var style = window.getComputedStyle(element);
+        var placeholder = document.createElement('div');
+        placeholder.className = 'rsteditor-placeholder';
+        placeholder.style.height = rect.height + 'px';
+        placeholder.style.marginTop = style.marginTop;
+        placeholder.style.marginBottom = style.marginBottom;
+        // offsets of source line anchors
+        var anchors = [];
+        if (element.hasAttribute('data-src')) {
+            anchors.push(0);
+        }
+        var inner = element.querySelectorAll('[data-src]');
+        for (var i = 0; i < inner.length; i++) {
+            anchors.push(inner[i].getBoundingClientRect().top - rect.top);
+        }
+        placeholder.rsteditorElement = element;
+        placeholder.rsteditorAnchors = anchors;
+        return placeholder;
+    },
+    restore: function(placeholder) {
+        var element = placeholder.rsteditorElement;
+        this.observer.unobserve(placeholder);
+        placeholder.replaceWith(element);
+        this.observer.observe(element);
+        return element;
+    },
+    restoreAll: function(pause) {
+        if (!this.enabled) {
+            return;
+        }
+        this.paused = !!pause;
+        var placeholders = document.querySelectorAll('.rsteditor-placeholder');
+        for (var i = 0; i < placeholders.length; i++) {
+            this.restore(placeholders[i]);
+        }
+    },
+};
+window.rsteditorVirtual.refresh();
+'''
+
+
+def registerScheme():
+    """ must be called before QApplication is created """
+    if not hasattr(QtWebEngineCore, 'QWebEngineUrlScheme'):
+        return
+    scheme = QtWebEngineCore.QWebEngineUrlScheme(SCHEME)
+    scheme.setSyntax(QtWebEngineCore.QWebEngineUrlScheme.Syntax.Path)
+    scheme.setFlags(QtWebEngineCore.QWebEngineUrlScheme.SecureScheme |
+                    QtWebEngineCore.QWebEngineUrlScheme.LocalScheme |
+                    QtWebEngineCore.QWebEngineUrlScheme.LocalAccessAllowed)
+    QtWebEngineCore.QWebEngineUrlScheme.registerScheme(scheme)
+
+
+class AssetStore(object):
+    """
+    Content of preview pages in memory, other files are read from disk
+    and cached by path, modification time and size.
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self._pages = {}
+        self._files = LRUCache(max_bytes)
+
+    def putPage(self, path, data):
+        self._pages[path] = data
+
+    def removePage(self, path):
+        self._pages.pop(path, None)
+
+    def get(self, path):
+        """ result: (mime type, data) or None """
+        data = self._pages.get(path)
+        if data is not None:
+            return b'text/html;charset=utf-8', data
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (path, stat.st_mtime, stat.st_size)
+        data = self._files.get(key)
+        if data is None:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError as err:
+                logger.error(err)
+                return None
+            self._files.put(key, data)
+        mime = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        return mime.encode('ascii'), data
+
+
+if QtWebEngineCore:
+    class PreviewSchemeHandler(QtWebEngineCore.QWebEngineUrlSchemeHandler):
+        """ serve rsteditor: urls from AssetStore """
+        def __init__(self, store, parent=None):
+            super(PreviewSchemeHandler, self).__init__(parent)
+            self.store = store
+
+        def requestStarted(self, job):
+            url = QtCore.QUrl(job.requestUrl())
+            url.setScheme('file')
+            asset = self.store.get(url.toLocalFile())
+            if asset is None:
+                job.fail(job.UrlNotFound)
+                return
+            mime, data = asset
+            # the engine reads buffer as needed, it is freed with job
+            buf = QtCore.QBuffer(job)
+            buf.setData(data)
+            buf.open(QtCore.QIODevice.ReadOnly)
+            job.reply(mime, buf)
+else:
+    PreviewSchemeHandler = None
 
 
 class WebView(QtWebEngineWidgets.QWebEngineView):
+    # first visible source line, 0-based, when preview is scrolled by user
+    sourceLineScrolled = QtCore.pyqtSignal(float)
+    # html of the last updateHtml is patched into the page or loaded
+    # page is shown, True when it was loaded instead of patched
+    htmlDisplayed = QtCore.pyqtSignal(bool)
     _case_sensitive = False
     _whole_word = False
+    _loaded = False
+    _html = ''
+    _url = None
+    _page_path = None
+    _page_count = 0
+    _update_count = 0
+    _patches_left = 0
+    assetStore = None
 
     def __init__(self, *args, **kwargs):
         super(WebView, self).__init__(*args, **kwargs)
         settings = self.settings()
         settings.setAttribute(settings.PluginsEnabled, False)
+        self.installSchemeHandler()
+        for name, source in [('rsteditorSync', SYNC_JS),
+                             ('rsteditorVirtual', VIRTUAL_JS)]:
+            script = QtWebEngineWidgets.QWebEngineScript()
+            script.setName(name)
+            script.setSourceCode(source)
+            script.setInjectionPoint(script.DocumentReady)
+            script.setWorldId(script.MainWorld)
+            script.setRunsOnSubFrames(False)
+            self.page().scripts().insert(script)
+        self.page().scrollPositionChanged.connect(self.onScrollPositionChanged)
         self.setHtml('')
         self.loadFinished.connect(self.onLoadFinished)
         # popup menu
@@ -29,19 +395,120 @@ class WebView(QtWebEngineWidgets.QWebEngineView):
             self.popupMenu.popup(event.globalPos())
 
     def onLoadFinished(self, ok):
+        self._loaded = ok
+        # an aborted load is followed by the load which replaced it
+        if ok:
+            self.htmlDisplayed.emit(True)
         return
 
+    def installSchemeHandler(self):
+        if not PreviewSchemeHandler:
+            return
+        profile = self.page().profile()
+        handler = profile.urlSchemeHandler(SCHEME)
+        if not handler:
+            handler = PreviewSchemeHandler(AssetStore(), profile)
+            profile.installUrlSchemeHandler(SCHEME, handler)
+        self.assetStore = handler.store
+
     def setHtml(self, html, url=None):
         if not url:
             url = ''
-        super(WebView, self).setHtml(
-            util.toUtf8(html),
-            QtCore.QUrl.fromLocalFile(url)
-        )
+        html = util.toUtf8(html)
+        self._loaded = False
+        self._html = html
+        self._url = url
+        if self.assetStore is None:
+            if len(html) > SETHTML_LIMIT:
+                logger.warning('Preview is too large: %s', len(html))
+            super(WebView, self).setHtml(
+                html,
+                QtCore.QUrl.fromLocalFile(url)
+            )
+            return
+        path = os.path.abspath(url) if url else os.path.abspath('preview.html')
+        if self._page_path and self._page_path != path:
+            self.assetStore.removePage(self._page_path)
+        self._page_path = path
+        self.assetStore.putPage(path, html.encode('utf-8'))
+        page_url = QtCore.QUrl.fromLocalFile(path)
+        page_url.setScheme(SCHEME.decode('ascii'))
+        # new query, engine must not reuse the last page
+        self._page_count += 1
+        page_url.setQuery('v=%s' % self._page_count)
+        self.load(page_url)
 
-    def scrollRatioPage(self, value, maximum):
-        scrollJS = 'window.scrollTo(0, document.body.scrollHeight * %s / %s);'
-        self.page().runJavaScript(scrollJS % (value, maximum))
+    def updateHtml(self, html, url=None):
+        """
+        patch changed elements of loaded page in place. The page is
+        reloaded when base url or head is changed.
+        """
+        if not url:
+            url = ''
+        html = util.toUtf8(html)
+        self._update_count += 1
+        patches = None
+        if self._loaded and url == self._url:
+            old_page, old_lines = htmldiff.split_line_map(self._html)
+            page, lines = htmldiff.split_line_map(html)
+            patches = htmldiff.diff_html(old_page, page)
+        if patches is None:
+            self.setHtml(html, url)
+            return
+        logger.debug('Patch preview: %s', len(patches))
+        self._html = html
+        self._patches_left = len(patches)
+        update = self._update_count
+        for path, start, count, fragment, length in patches:
+            script = PATCH_JS % (json.dumps(path), start, count,
+                                 json.dumps(fragment))
+            self.page().runJavaScript(
+                script, lambda result, length=length:
+                    self.onPatched(result, length, update))
+        if lines != old_lines:
+            self.page().runJavaScript(LINES_JS % json.dumps(lines))
+        if not patches:
+            # no element changed, shown when control returns to event loop
+            QtCore.QTimer.singleShot(0, lambda: self.htmlDisplayed.emit(False))
+
+    def onPatched(self, result, length, update):
+        if update != self._update_count or not self._patches_left:
+            return
+        # DOM is not what we think, load it again
+        if result != length:
+            logger.debug('Patch preview failed, reload')
+            self._patches_left = 0
+            self.setHtml(self._html, self._url)
+            return
+        self._patches_left -= 1
+        if not self._patches_left:
+            self.htmlDisplayed.emit(False)
+
+    def scrollSourceLine(self, line, value, maximum):
+        """
+        scroll to source line, 0-based. Page without line map is scrolled
+        by ratio of value and maximum.
+        """
+        scrollJS = '''
+        if (window.rsteditorSync) {
+            window.rsteditorSync.scrollToLine(%s, %s);
+        } else {
+            window.scrollTo(0, document.body.scrollHeight * %s);
+        }
+        '''
+        ratio = float(value) / maximum if maximum else 0
+        self.page().runJavaScript(scrollJS % (line + 1, ratio, ratio))
+
+    def onScrollPositionChanged(self, pos):
+        # only scroll of user, not of scrollSourceLine
+        if not self.underMouse():
+            return
+        scrollJS = 'window.rsteditorSync ? window.rsteditorSync.lineAt(%s) : -1;'
+        self.page().runJavaScript(scrollJS % pos.y(), self.onSourceLine)
+
+    def onSourceLine(self, line):
+        if line is not None and line >= 1:
+            self.sourceLineScrolled.emit(line - 1)
 
     def print_(self, printer):
         """ QWebEngineView don't support print in Qt5.7 """
@@ -59,7 +526,14 @@ class WebView(QtWebEngineWidgets.QWebEngineView):
         self._whole_word = finddialog.isWholeWord()
 
     def findNext(self, text):
+        self.restoreAll()
         self.page().findText(text, self.page().FindFlags())
 
     def findPrevious(self, text):
+        self.restoreAll()
         self.page().findText(text, self.page().FindBackward)
+
+    def restoreAll(self):
+        """ attach detached sections of huge page, such as for find """
+        self.page().runJavaScript(
+            'if (window.rsteditorVirtual) { window.rsteditorVirtual.restoreAll(true); }')
@@ -4,4 +4,5 @@
 from rsteditor import app
 
 
-app.main()
+if __name__ == '__main__':
+    app.main()
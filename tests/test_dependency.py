@@ -0,0 +1,100 @@
+import os
+
+import pytest
+from docutils.core import publish_doctree
+from docutils.parsers.rst import directives
+from docutils.parsers.rst.directives import misc, tables
+
+from rsteditor import dependency
+
+INCLUDED = 'A\n\nB\nC\n\nD\nE\n'
+CSV = 'a,b\n1,2\n'
+
+dependency.register()
+
+
+def doctree(text, path):
+    document = publish_doctree(text, source_path=path,
+                               settings_overrides={'report_level': 5,
+                                                   'halt_level': 5})
+    return document.pformat(), document.settings.record_dependencies.list
+
+
+def stock_doctree(monkeypatch, text, path):
+    with monkeypatch.context() as m:
+        m.setitem(directives._directives, 'include', misc.Include)
+        m.setitem(directives._directives, 'csv-table', tables.CSVTable)
+        return doctree(text, path)
+
+
+@pytest.fixture
+def files(tmp_path):
+    (tmp_path / 'included.txt').write_text(INCLUDED, encoding='utf-8')
+    (tmp_path / 'latin.txt').write_bytes('ä\n'.encode('latin-1'))
+    (tmp_path / 'table.csv').write_text(CSV, encoding='utf-8')
+    dependency.fileCache.clear()
+    return tmp_path
+
+
+@pytest.mark.parametrize('options', [
+    '',
+    ':start-line: 2',
+    ':end-line: 3',
+    ':start-line: 1\n   :end-line: -1',
+    ':start-after: B',
+    ':end-before: D',
+    ':start-after: C\n   :end-before: E',
+    ':start-after: missing',
+    ':end-before: missing',
+    ':literal:',
+    ':code: text\n   :start-line: 2',
+])
+def test_include_as_docutils(monkeypatch, files, options):
+    text = 'Text\n\n.. include:: included.txt\n   %s\n' % options
+    path = str(files / 'doc.rst')
+    assert doctree(text, path) == stock_doctree(monkeypatch, text, path)
+
+
+@pytest.mark.parametrize('text', [
+    '.. include:: latin.txt\n   :encoding: ascii\n',
+    '.. csv-table::\n   :file: table.csv\n',
+])
+def test_file_errors_as_docutils(monkeypatch, files, text):
+    path = str(files / 'doc.rst')
+    assert doctree(text, path) == stock_doctree(monkeypatch, text, path)
+
+
+@pytest.mark.parametrize('text', [
+    '.. include:: missing.txt\n',
+    '.. csv-table::\n   :file: missing.txt\n',
+])
+def test_missing_file(monkeypatch, files, text):
+    path = str(files / 'doc.rst')
+    tree, paths = doctree(text, path)
+    assert tree == stock_doctree(monkeypatch, text, path)[0]
+    # created later, the preview is rendered again
+    assert paths == [str(files / 'missing.txt')]
+
+
+def test_file_cache(files):
+    path = str(files / 'included.txt')
+    cache = dependency.FileCache(1024)
+    assert cache.read(path) == INCLUDED
+    assert cache.read(path) == INCLUDED
+    assert cache.stats()['hits'] == 1
+    (files / 'included.txt').write_text('changed\n', encoding='utf-8')
+    assert cache.read(path) == 'changed\n'
+    with pytest.raises(OSError):
+        cache.read(str(files / 'missing.txt'))
+
+
+def test_changed(files):
+    snapshot = dependency.snapshot([str(files / 'included.txt'),
+                                    str(files / 'missing.txt')])
+    assert not dependency.changed(snapshot)
+    (files / 'missing.txt').write_text('created', encoding='utf-8')
+    assert dependency.changed(snapshot)
+    os.remove(str(files / 'missing.txt'))
+    assert not dependency.changed(snapshot)
+    (files / 'included.txt').write_text('modified', encoding='utf-8')
+    assert dependency.changed(snapshot)
@@ -0,0 +1,34 @@
+import multiprocessing
+
+from rsteditor import executor
+
+TEXT = 'Title\n=====\n\ntext\n'
+CACHES = ['Renderer', 'Highlight', 'Math', 'Files']
+
+
+def test_thread_cache_stats():
+    pool = executor.ThreadExecutor()
+    assert pool.render(TEXT).startswith(b'<!DOCTYPE html>')
+    assert [name for name, _ in pool.cacheStats()] == CACHES
+
+
+def test_process_timeout_restarts_pool():
+    pool = executor.ProcessExecutor()
+    try:
+        assert pool.cacheStats() == []
+        old = pool._pool
+        # workers are still warming up
+        pool.render_timeout = 0.001
+        assert isinstance(pool.render(TEXT), str)
+        assert pool._pool is not old
+        # workers of old pool are stopped
+        assert len(multiprocessing.active_children()) == 1
+        pool.render_timeout = executor.ProcessExecutor.render_timeout
+        timings = {}
+        assert pool.render(TEXT, timings=timings).startswith(b'<!DOCTYPE html>')
+        assert 'parse' in timings
+        stats = dict(pool.cacheStats())
+        assert list(stats) == CACHES
+        assert stats['Renderer']['fallback'] > 0
+    finally:
+        pool.shutdown()
@@ -0,0 +1,32 @@
+from docutils.core import publish_string
+from docutils.parsers.rst.directives import body
+from docutils.utils import code_analyzer
+
+from rsteditor import highlight
+
+SOURCE = '''\
+.. code:: python
+   :number-lines: 3
+
+   def f(x):
+       return x + 1
+
+.. code:: nolexer
+
+   text
+'''
+
+
+def render():
+    return publish_string(SOURCE, writer='html5', settings_overrides={
+        'report_level': 5, 'output_encoding': 'unicode'})
+
+
+def test_code_as_docutils(monkeypatch):
+    highlight.register()
+    cached = render()
+    hits = highlight.tokenCache.stats()['hits']
+    assert render() == cached
+    assert highlight.tokenCache.stats()['hits'] > hits
+    monkeypatch.setattr(body, 'Lexer', code_analyzer.Lexer)
+    assert render() == cached
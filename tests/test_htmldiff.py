@@ -0,0 +1,59 @@
+import json
+
+from rsteditor import output
+from rsteditor.htmldiff import diff_html, split_elements, split_line_map
+
+
+def document(words):
+    return ''.join('Section %s\n==========\n\nParagraph %s of section.\n\n'
+                   % (x, word) for x, word in enumerate(words))
+
+
+def render(text):
+    return output.rst2htmlcode(text).decode('utf-8')
+
+
+def test_split_nested_raw_elements():
+    html = '<main><p>a</p><script>[1]</script><style>p>b{}</style></main>'
+    elements = split_elements(html)
+    assert [e[0] for e in elements] == ['main']
+    inner = split_elements(html, elements[0][2], elements[0][3])
+    assert [(e[0], html[e[1]:e[4]]) for e in inner] == [
+        ('p', '<p>a</p>'),
+        ('script', '<script>[1]</script>'),
+        ('style', '<style>p>b{}</style>'),
+    ]
+
+
+def test_split_unbalanced():
+    assert split_elements('<div>a</div></div>') is None
+    assert split_elements('<main><script>[1]</main>') is None
+
+
+def test_diff_word():
+    words = ['w%s' % x for x in range(20)]
+    old = render(document(words))
+    words[1] = 'changed'
+    patches = diff_html(old, render(document(words)))
+    assert patches is not None and len(patches) == 1
+    path, start, count, fragment, length = patches[0]
+    assert count == 1
+    assert fragment == '<p data-src="">Paragraph changed of section.</p>'
+
+
+def test_diff_line_map():
+    words = ['w%s' % x for x in range(20)]
+    old_page, old_lines = split_line_map(render(document(words)))
+    text = document(words).replace('Paragraph w1 ', 'Paragraph\nw1 ')
+    page, lines = split_line_map(render(text))
+    assert json.loads(lines) != json.loads(old_lines)
+    assert 'rsteditor-lines"></script>' in page
+    patches = diff_html(old_page, page)
+    assert patches is not None and len(patches) == 1
+    assert patches[0][2] == 1
+
+
+def test_diff_head():
+    old = render(document(['a', 'b']))
+    new = old.replace('<title>', '<title>x')
+    assert diff_html(old, new) is None
@@ -0,0 +1,93 @@
+import os
+import re
+
+import pytest
+
+from rsteditor import output
+from rsteditor.incremental import IncrementalRenderer
+
+DOCS = os.path.join(os.path.dirname(__file__), os.pardir,
+                    'rsteditor', 'share', 'rsteditor', 'docs')
+SECTION = re.compile(r'<(/?)section\b[^>]*>')
+# table of contents of a partial render lists written sections only
+TOC_ENTRY = re.compile(r'toc-entry-\d+')
+
+
+def render(text, path, focus=None, fallback=False):
+    renderer = IncrementalRenderer()
+    if fallback:
+        renderer.min_chunks = float('inf')
+    overrides = dict(output.default_overrides)
+    overrides.update(output.get_theme_settings('docutils', None))
+    context = output.get_render_context('html5', overrides)
+    return renderer.render(text, context, focus=focus,
+                           source_path=path).decode('utf-8')
+
+
+def sections(html):
+    """ top level sections of html """
+    result = []
+    depth = start = 0
+    for mo in SECTION.finditer(html):
+        if mo.group(1):
+            depth -= 1
+            if depth == 0:
+                result.append(TOC_ENTRY.sub('toc-entry', html[start:mo.end()]))
+        else:
+            if depth == 0:
+                start = mo.start()
+            depth += 1
+    return result
+
+
+@pytest.mark.parametrize('name, focus', [
+    ('cheatsheet.rst', 1),
+    ('cheatsheet.rst', 79),
+    ('cheatsheet.rst', 105),
+    ('directives.rst', 1351),
+])
+@pytest.mark.parametrize('fallback', [False, True])
+def test_focus_sections_as_full(name, focus, fallback):
+    path = os.path.abspath(os.path.join(DOCS, name))
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    full = render(text, path)
+    partial = render(text, path, focus, fallback)
+    assert partial.count('<section') < full.count('<section')
+    assert partial.count('Anonymous hyperlink mismatch') == \
+        full.count('Anonymous hyperlink mismatch')
+    full_sections = sections(full)
+    for section in sections(partial):
+        assert section in full_sections
+
+
+@pytest.mark.parametrize('separator', ['\x0c', '\x0b', '\x1c', '\x85',
+                                       '\u2028', '\r\n'])
+def test_split_lines_as_parser(separator):
+    text = ''.join('%s\n=====\n\nfirst%slast\n\n' % (title, separator)
+                   for title in ('One', 'Two', 'Three', 'Four', 'Five'))
+    assert render(text, None) == render(text, None, fallback=True)
+    for focus in range(1, text.count('\n') + 1):
+        assert render(text, None, focus) == render(text, None, focus, True)
+
+
+def test_chunks_as_document():
+    path = os.path.abspath(os.path.join(DOCS, 'cheatsheet.rst'))
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    assert render(text, path) == render(text, path, fallback=True)
+
+
+@pytest.mark.parametrize('definition, message', [
+    ('.. |s| replace:: %s', 'Duplicate substitution definition name'),
+    ('.. _a: http://example.com/%s', 'Duplicate explicit target name'),
+])
+def test_duplicate_names_as_document(definition, message):
+    text = ''.join('%s\n=====\n\nText |s| a_.\n\n%s\n\n'
+                   % (title, definition % title if title in 'AC' else '')
+                   for title in 'ABCDE')
+    full = render(text, None, fallback=True)
+    assert message in full
+    assert render(text, None) == full
+    for focus in (1, 20):
+        assert render(text, None, focus) == render(text, None, focus, True)
@@ -0,0 +1,55 @@
+from rsteditor import output
+
+TEXT = '''\
+Title
+=====
+
+.. code:: python
+
+   print(1)
+'''
+
+
+def head(html):
+    html = html.decode('utf-8')
+    return html[:html.index('</head>')]
+
+
+def test_draft_head_as_final():
+    for mode in output.math_outputs:
+        settings = output.get_math_overrides(mode)
+        final = output.rst2htmlcode(TEXT, settings=settings)
+        settings.update(output.draft_overrides)
+        draft = output.rst2htmlcode(TEXT, settings=settings)
+        assert draft != final
+        assert head(draft) == head(final)
+
+
+def test_strip_source_lines(monkeypatch):
+    html = output.rst2htmlcode(TEXT)
+    assert b'data-src' in html
+    stripped = output.strip_source_lines(html)
+    assert output.strip_source_lines(html.decode('utf-8')) == \
+        stripped.decode('utf-8')
+    monkeypatch.setattr(output, 'source_line_translator_class',
+                        lambda translator_class: translator_class)
+    monkeypatch.setattr(output, 'renderContexts', type(output.renderContexts)())
+    output.previewRenderer.clear()
+    assert stripped == output.rst2htmlcode(TEXT)
+
+
+def test_stylesheet_and_template_files(tmp_path):
+    css = tmp_path / 'style.css'
+    css.write_text('p { color: red; }')
+    template = tmp_path / 'template.txt'
+    template.write_text('%(body)s')
+    settings = {'stylesheet_path': str(css), 'template': str(template)}
+    dependencies = []
+    html = output.rst2htmlcode(TEXT, settings=settings,
+                               dependencies=dependencies)
+    assert str(css) in [path for path, _ in dependencies]
+    css.write_text('p { color: blue; }')
+    template.write_text('%(stylesheet)s<hr>%(body)s')
+    changed = output.rst2htmlcode(TEXT, settings=settings)
+    assert changed != html
+    assert changed.startswith(b'<style type="text/css">\n\np { color: blue; }')
@@ -0,0 +1,238 @@
+import os
+import re
+import glob
+import random
+
+import pytest
+
+pytest.importorskip('PyQt5.Qsci')
+
+from PyQt5 import QtWidgets  # noqa: E402
+from PyQt5.Qsci import QsciScintilla  # noqa: E402
+
+from rsteditor.editor import Editor  # noqa: E402
+from rsteditor.scilib.scilexerrest_py import (  # noqa: E402
+    QsciLexerRest, RegexTokenizer, StyledSpans, TextRange)
+
+FLAGS = re.UNICODE | re.MULTILINE | re.IGNORECASE
+BLOCK_TOKENS = [(key, regex) for key, regex in QsciLexerRest.token_regex
+                if not key.startswith('in_')]
+DOCS = os.path.join(os.path.dirname(__file__), os.pardir,
+                    'rsteditor', 'share', 'rsteditor', 'docs')
+CHARS = ' \n.:_-=*`|>[]()#+/\\ab1ÄßİK'
+# multi-byte characters and line ends other than \n
+WIDE_TEXTS = [
+    '中文标题\n========\n\n这是 *强调* 和 **粗体** 以及 ``代码`` 链接_ 。\n\n'
+    '* 列表 一\n* 列表 二 😀\n\n.. note:: 注意\n\n   内容 http://例子.com/ 。\n\n' * 20,
+    'Title\r\n=====\r\n\r\npara: text *em* ünï\r\n\r\n' * 20,
+    'Mac\r===\r\rold *line* ends ß\r\r' * 20,
+]
+WIDE_IDS = ['cjk', 'crlf', 'cr']
+EDITS = ['\n', 'x', '* ', '.. ', '::\n\n  ', 'é', '\n=====\n']
+
+
+def documents():
+    texts = []
+    for path in sorted(glob.glob(os.path.join(DOCS, '*.rst'))):
+        with open(path, encoding='utf-8') as f:
+            texts.append(f.read())
+    return texts
+
+
+def fuzzed(texts, count, seed=1):
+    """ lines of texts shuffled, with random characters inserted """
+    rnd = random.Random(seed)
+    lines = [line for text in texts for line in text.splitlines(True)]
+    result = []
+    for x in range(count):
+        chars = list(''.join(rnd.choice(lines)
+                             for _ in range(rnd.randint(1, 40))))
+        for _ in range(rnd.randint(0, 10)):
+            chars.insert(rnd.randint(0, len(chars)), rnd.choice(CHARS))
+        result.append(''.join(chars))
+        result.append(''.join(rnd.choice(CHARS)
+                              for _ in range(rnd.randint(1, 80))))
+    return result
+
+
+def tokenize(match, text):
+    tokens = []
+    offset = 0
+    while offset < len(text):
+        key, end = match(text, offset)
+        tokens.append((key, end))
+        offset = end
+    return tokens
+
+
+def test_tokenizer_as_ordered_regex():
+    regexes = [(key, re.compile(regex, FLAGS)) for key, regex in BLOCK_TOKENS]
+
+    def ordered(text, offset):
+        for key, regex in regexes:
+            mo = regex.match(text, offset)
+            if mo:
+                return key, mo.end()
+
+    tokenizer = RegexTokenizer(BLOCK_TOKENS, FLAGS)
+
+    def combined(text, offset):
+        mo = tokenizer.match(text, offset)
+        return mo.lastgroup, mo.end()
+
+    texts = documents()
+    for text in texts + fuzzed(texts, 300):
+        assert tokenize(combined, text) == tokenize(ordered, text)
+
+
+class CharSpans(object):
+    """ span id of every character, spans keep their characters """
+    def __init__(self):
+        self.ids = []
+        self.keys = {}
+
+    def spans(self):
+        result = []
+        for pos, span_id in enumerate(self.ids):
+            if span_id is None:
+                continue
+            if pos and self.ids[pos - 1] == span_id:
+                start, length, key = result[-1]
+                result[-1] = (start, length + 1, key)
+            else:
+                result.append((pos, 1, self.keys[span_id]))
+        return result
+
+    def replace(self, start, end, spans):
+        for pos in range(start, len(self.ids)):
+            span_id = self.ids[pos]
+            if span_id is not None and \
+                    (pos == 0 or self.ids[pos - 1] != span_id):
+                if pos >= end:
+                    break
+                while pos < len(self.ids) and self.ids[pos] == span_id:
+                    self.ids[pos] = None
+                    pos += 1
+        for span_start, length, key in spans:
+            span_id = len(self.keys)
+            self.keys[span_id] = key
+            self.ids[span_start:span_start + length] = [span_id] * length
+
+    def insertText(self, pos, length):
+        inside = 0 < pos < len(self.ids) and \
+            self.ids[pos - 1] == self.ids[pos]
+        self.ids[pos:pos] = [self.ids[pos] if inside else None] * length
+
+    def deleteText(self, pos, length):
+        del self.ids[pos:pos + length]
+
+
+def tiling(rnd, start, end):
+    spans = []
+    while start < end:
+        length = min(rnd.randint(1, 12), end - start)
+        spans.append((start, length, rnd.choice('abc')))
+        start += length
+    return spans
+
+
+def test_styled_spans_follow_text():
+    rnd = random.Random(2)
+    for run in range(50):
+        spans = StyledSpans()
+        model = CharSpans()
+        size = rnd.randint(0, 200)
+        model.ids = [None] * size
+        for step in range(100):
+            op = rnd.random()
+            if op < 0.2 or not size:
+                # restyle from one span start to another
+                bounds = sorted(set(spans.starts) | {0, size})
+                a, b = sorted(rnd.sample(bounds, 2)) if len(bounds) > 1 \
+                    else (0, size)
+                new = tiling(rnd, a, b)
+                spans.replace(a, b, new)
+                model.replace(a, b, new)
+            elif op < 0.6:
+                pos = rnd.randint(0, size)
+                length = rnd.randint(1, 20)
+                spans.insertText(pos, length)
+                model.insertText(pos, length)
+                size += length
+            else:
+                pos = rnd.randint(0, size - 1)
+                length = rnd.randint(1, min(30, size - pos))
+                spans.deleteText(pos, length)
+                model.deleteText(pos, length)
+                size -= length
+            assert list(zip(spans.starts, spans.lengths, spans.keys)) == \
+                model.spans()
+            for start, length, key in model.spans():
+                assert spans.keyAt(start) == key
+
+
+@pytest.fixture(scope='module')
+def qapp():
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def styled_editor(text):
+    editor = Editor(None)
+    editor.setLexer(QsciLexerRest(editor))
+    editor.setText(text)
+    editor.recolor()
+    return editor
+
+
+def styles(editor):
+    return [editor.SendScintilla(QsciScintilla.SCI_GETSTYLEAT, pos)
+            for pos in range(editor.length())]
+
+
+def edit_texts():
+    params = []
+    for path in sorted(glob.glob(os.path.join(DOCS, '*.rst'))):
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+        # whole lines, styles are compared at every position
+        params.append(pytest.param(text[:text.find('\n', 12000) + 1],
+                                   id=os.path.basename(path)))
+    params.extend(pytest.param(text, id=name) for name, text in
+                  zip(WIDE_IDS, WIDE_TEXTS))
+    return params
+
+
+@pytest.mark.parametrize('text', edit_texts())
+def test_restyle_as_fresh(qapp, text):
+    editor = styled_editor(text)
+    rnd = random.Random(len(text))
+    for step in range(10):
+        pos = rnd.randrange(max(editor.length(), 1))
+        line, index = editor.lineIndexFromPosition(pos)
+        if rnd.random() < 0.3:
+            editor.setSelection(line, 0, line + 1, 0)
+            editor.removeSelectedText()
+        else:
+            editor.insertAt(rnd.choice(EDITS), line, index)
+        editor.SendScintilla(QsciScintilla.SCI_COLOURISE, 0, -1)
+        assert styles(editor) == styles(styled_editor(editor.text()))
+
+
+@pytest.mark.parametrize('text', WIDE_TEXTS, ids=WIDE_IDS)
+def test_text_range_positions(qapp, text):
+    editor = Editor(None)
+    editor.setText(text)
+    lines = editor.lines()
+    for first in (0, 1, lines // 2):
+        text_range = TextRange(editor, first, lines - 1)
+        start = editor.positionFromLineIndex(first, 0)
+        assert text_range.start == start
+        for offset in range(len(text_range.text) + 1):
+            assert text_range.position(offset) == \
+                start + len(text_range.text[:offset].encode('utf-8'))
+        # the last line has no line end, a range ends before it
+        for line in range(first, lines - 1):
+            assert text_range.position(text_range.lineOffset(line)) == \
+                editor.positionFromLineIndex(line, 0)
+            assert text_range.line(line) == editor.text(line)